@@ -0,0 +1,226 @@
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+import pygame
+
+import main
+import mapgen
+
+BENCHMARK_MAPS = ('map.png',)
+BENCHMARK_TICK = 1000 / main.SIMULATION_TICK_RATE  # ms
+BENCHMARK_BULLETS = 1000
+BENCHMARK_STATIC_LIGHTS = 300
+BENCHMARK_DYNAMIC_LIGHTS = 100
+BENCHMARK_CROWD = 2000
+BENCHMARK_CROWD_RADIUS = 2 * main.ENEMY_OBSERVATION_RADIUS  # world tiles
+
+# (frames, held keys, click position on screen or None)
+BENCHMARK_SCRIPT = (
+    (60, (pygame.K_d,), None),
+    (60, (pygame.K_s,), (600, 400)),
+    (60, (pygame.K_a,), (40, 400)),
+    (60, (pygame.K_w,), (320, 20)),
+    (60, (pygame.K_d, pygame.K_w), (600, 20)),
+    (60, (), None),
+)
+
+
+class ScriptedKeys:
+
+    def __init__(self, keys):
+        self._keys = frozenset(keys)
+
+    def __getitem__(self, key):
+        return key in self._keys
+
+
+def iterate_script(script):
+    for frames, keys, click in script:
+        keys_pressed = ScriptedKeys(keys)
+        for frame in range(frames):
+            events = list()
+            if click is not None and frame % 20 == 0:
+                events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=click))
+            yield events, keys_pressed
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': samples[0],
+        'median_ms': statistics.median(samples),
+        'mean_ms': statistics.fmean(samples),
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max_ms': samples[-1],
+    }
+
+
+def synced(function, *args):
+    function(*args)
+    main.job_system.sync()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def bench_map_load(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    path = main.get_compiled_map_path(os.path.join('resources', map_name))
+    return [timed(main.GameWorld, path, main.DISPLAY_SIZE) for _ in range(repeats)]
+
+
+def bench_lighting(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    samples = list()
+    for _ in range(repeats):
+        main.player.get_light_source().mark_dirty()
+        samples.append(timed(synced, main.world.update_light_sources))
+    return samples
+
+
+def bench_many_lights(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    rng = random.Random(0)
+    floor = [tuple(tile) for tile in np.argwhere(main.world.get_tile_types() == main.TILE_FLOOR).tolist()]
+    for x, y in rng.sample(floor, min(len(floor), BENCHMARK_STATIC_LIGHTS)):
+        main.world.add_light_source(main.LightSource((x * main.WORLD_TILE_SIZE, y * main.WORLD_TILE_SIZE),
+                                                     main.TORCH_LIGHT_RADIUS, main.TORCH_LIGHT_INTENSITY, static=True))
+    player_position = main.player.get_position()
+    for _ in range(BENCHMARK_DYNAMIC_LIGHTS):
+        main.world.add_light_source(main.LightSource((player_position[0] + rng.uniform(-320, 320),
+                                                      player_position[1] + rng.uniform(-240, 240)), 3, 0.3))
+    keys_pressed = ScriptedKeys(())
+    return [timed(main.loop, BENCHMARK_TICK, [], keys_pressed) for _ in range(repeats)]
+
+
+def bench_enemy_ai(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    return [timed(synced, main.world.update_enemies, BENCHMARK_TICK, main.player) for _ in range(repeats)]
+
+
+def bench_crowd(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    rng = random.Random(0)
+    player_tile = np.array(main.player.get_position()) // main.WORLD_TILE_SIZE
+    floor = np.argwhere(main.world.get_tile_types() == main.TILE_FLOOR)
+    floor = floor[np.abs(floor - player_tile).max(axis=1) <= BENCHMARK_CROWD_RADIUS].tolist()
+    for _ in range(BENCHMARK_CROWD):
+        x, y = rng.choice(floor)
+        main.world.add_enemy(main.Enemy((x * main.WORLD_TILE_SIZE, y * main.WORLD_TILE_SIZE)))
+    return [timed(synced, main.world.update_enemies, BENCHMARK_TICK, main.player) for _ in range(repeats)]
+
+
+def bench_bullets(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    samples = list()
+    for i in range(repeats):
+        if i % 60 == 0:
+            for j in range(BENCHMARK_BULLETS):
+                angle = j * 2 * math.pi / BENCHMARK_BULLETS
+                velocity = (main.BULLET_SPEED * math.cos(angle), main.BULLET_SPEED * math.sin(angle))
+                main.world.add_bullet(main.player.get_position(), velocity)
+        samples.append(timed(main.world.update_bullets, BENCHMARK_TICK))
+    return samples
+
+
+def bench_frame(map_name, repeats):
+    main.setup(headless=True, map_name=map_name)
+    samples = list()
+    for events, keys_pressed in iterate_script(BENCHMARK_SCRIPT * max(1, repeats // 360)):
+        samples.append(timed(main.loop, BENCHMARK_TICK, events, keys_pressed))
+    return samples
+
+
+def bench_replay(recording_path):
+    recording = main.InputRecording.load(recording_path)
+    main.setup(headless=True, map_name=recording.get_map_name())
+    samples = list()
+    for dt, events, keys_pressed, quality_level, _ in recording.get_frames():
+        main.quality_governor.set_level(quality_level)
+        samples.append(timed(main.loop, dt, events, keys_pressed))
+    return samples
+
+
+BENCHMARKS = {
+    'map_load': (bench_map_load, 5),
+    'lighting': (bench_lighting, 200),
+    'many_lights': (bench_many_lights, 200),
+    'enemy_ai': (bench_enemy_ai, 300),
+    'crowd': (bench_crowd, 300),
+    'bullets': (bench_bullets, 300),
+    'frame': (bench_frame, 360),
+}
+
+
+def run(names, maps, scale, recordings=()):
+    results = dict()
+    for map_name in maps:
+        for name in names:
+            function, repeats = BENCHMARKS[name]
+            key = f'{name}[{map_name}]'
+            results[key] = summarize(function(map_name, max(1, int(repeats * scale))))
+            print(f'{key:40} median {results[key]["median_ms"]:9.3f} ms  p95 {results[key]["p95_ms"]:9.3f} ms')
+    for recording_path in recordings:
+        key = f'replay[{os.path.basename(recording_path)}]'
+        results[key] = summarize(bench_replay(recording_path))
+        print(f'{key:40} median {results[key]["median_ms"]:9.3f} ms  p95 {results[key]["p95_ms"]:9.3f} ms')
+    main.clear()
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = list()
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['median_ms'], result['median_ms']
+        change = (new - old) / old if old else 0.0
+        mark = '  REGRESSION' if change > threshold else ''
+        print(f'{key:40} {old:9.3f} -> {new:9.3f} ms  {change * 100:+7.1f}%{mark}')
+        if change > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Headless game loop benchmarks.')
+    parser.add_argument('--bench', action='append', choices=sorted(BENCHMARKS), help='benchmark to run (default: all)')
+    parser.add_argument('--map', action='append', help='map from resources/ to run on (default: reference maps)')
+    parser.add_argument('--generate', action='append', type=mapgen.parse_size, default=[], metavar='SIZE',
+                        help='also run on a generated map of this size, WIDTHxHEIGHT or SIDE')
+    parser.add_argument('--replay', action='append', default=[], help='also time every frame of this input recording')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number of runs')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against results from this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed median slowdown when comparing')
+    return parser.parse_args()
+
+
+def run_benchmarks():
+    args = parse_args()
+    recordings = [os.path.abspath(path) for path in args.replay]
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    maps = (args.map or list(BENCHMARK_MAPS)) + [mapgen.ensure_generated_map(size) for size in args.generate]
+    results = run(args.bench or list(BENCHMARKS), maps, args.scale, recordings)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -1,40 +1,284 @@
 import pygame
-from itertools import product
+from itertools import chain, product, zip_longest
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from PIL import Image
+import numpy as np
 
 import os
+import argparse
+import csv
+import json
 import math
+import mmap
+import struct
+import sys
+import time
+import zlib
 
 DISPLAY_SIZE = (640, 480)
+FRAME_RATE_LIMIT = 0  # frames per second, 0 - no limit
+VSYNC = False
+DIRTY_RECT_RENDERING = False
+DIRTY_RECT_LIMIT = 48  # rects per frame before falling back to a full redraw
+
+SIMULATION_TICK_RATE = 60  # ticks per second
+SIMULATION_MAX_TICKS_PER_FRAME = 5
 
 WORLD_MAP_NAME = 'map.png'
+WORLD_MAP_COMPILED_EXTENSION = '.ylmap'
 WORLD_TILE_SIZE = 32
 
 PLAYER_SPRITE_SIZE = 32
 PLAYER_SPEED = 3 * WORLD_TILE_SIZE  # pixels per second
 
+CHUNK_CACHE_SIZE = 16  # chunks
+CHUNK_PREFETCH_MARGIN = 1  # chunks
+
 LIGHT_SOURCE_RADIUS = 7  # world tiles
+LIGHT_MASK_SMOOTH = False
+TORCH_LIGHT_RADIUS = 5  # world tiles
+TORCH_LIGHT_INTENSITY = 0.8
+STATIC_LIGHT_BAKE_LIMIT = 16  # static lights per frame, nearest to the view first
+BULLET_LIGHT_RADIUS = 2  # world tiles
+BULLET_LIGHT_INTENSITY = 0.5
+MUZZLE_FLASH_RADIUS = 4  # world tiles
+MUZZLE_FLASH_INTENSITY = 0.6
+MUZZLE_FLASH_DURATION = 80  # ms
 ENEMY_OBSERVATION_RADIUS = 8  # world tiles
+ENEMY_ACTIVE_RADIUS = 4  # world tiles, closer enemies think every tick
+ENEMY_NEAR_UPDATE_INTERVAL = 4  # ticks between updates of enemies outside the active radius
+ENEMY_AI_BUDGET = 64  # enemy decisions per tick, the rest reuse their last decision
+FLOW_FIELD_MAX_DISTANCE = 3 * ENEMY_OBSERVATION_RADIUS  # world tiles, None - whole map
+LINE_OF_SIGHT_CACHE_SIZE = 65536  # tile pairs
+SPATIAL_HASH_CELL_SIZE = 2 * WORLD_TILE_SIZE  # pixels
+ENTITY_INDEX_BITS = 24  # low bits of an entity id, the rest is the slot generation
 
 ENEMY_ATTACK_PERIOD = 1000  # ms
 PLAYER_ATTACK_PERIOD = 333  # ms
 
 BULLET_SPEED = 7 * WORLD_TILE_SIZE  # pixels per second
+BULLET_POOL_SIZE = 256
+
+TEXT_CACHE_SIZE = 256  # rendered text surfaces
+
+WORKER_POOL = None  # 'thread', 'process' or None - run jobs on the main thread
+WORKER_COUNT = None  # None - one per CPU
+
+PROFILER_HISTORY = 600  # frames
+PROFILER_OVERLAY = False
+
+QUALITY_GOVERNOR = True
+QUALITY_TARGET_FRAME_TIME = 1000 / 60  # ms
+QUALITY_WINDOW = 30  # frames between decisions
+QUALITY_DOWNGRADE_RATIO = 1.1  # p90 frame time over target that lowers quality
+QUALITY_UPGRADE_RATIO = 0.6  # p90 frame time over target that raises quality
+QUALITY_LEVELS = (
+    {'light_radius': LIGHT_SOURCE_RADIUS, 'light_mask_smooth': LIGHT_MASK_SMOOTH, 'light_mask_interval': 1,
+     'bullet_lights': True, 'ai_budget': ENEMY_AI_BUDGET, 'ai_near_interval': ENEMY_NEAR_UPDATE_INTERVAL},
+    {'light_radius': LIGHT_SOURCE_RADIUS - 1, 'light_mask_smooth': False, 'light_mask_interval': 1,
+     'bullet_lights': True, 'ai_budget': ENEMY_AI_BUDGET * 3 // 4, 'ai_near_interval': ENEMY_NEAR_UPDATE_INTERVAL},
+    {'light_radius': LIGHT_SOURCE_RADIUS - 2, 'light_mask_smooth': False, 'light_mask_interval': 2,
+     'bullet_lights': False, 'ai_budget': ENEMY_AI_BUDGET // 2, 'ai_near_interval': ENEMY_NEAR_UPDATE_INTERVAL * 2},
+    {'light_radius': LIGHT_SOURCE_RADIUS - 3, 'light_mask_smooth': False, 'light_mask_interval': 4,
+     'bullet_lights': False, 'ai_budget': ENEMY_AI_BUDGET // 4, 'ai_near_interval': ENEMY_NEAR_UPDATE_INTERVAL * 3},
+)
+
+
+class JobSystem:
+
+    def __init__(self, pool=WORKER_POOL, workers=WORKER_COUNT):
+        if pool == 'thread':
+            self._executor = ThreadPoolExecutor(workers)
+        elif pool == 'process':
+            self._executor = ProcessPoolExecutor(workers)
+        else:
+            self._executor = None
+        self._pending = dict()
+
+    def submit(self, key, callback, function, *args):
+        if key in self._pending:
+            return False
+        if self._executor is None:
+            future = Future()
+            future.set_result(function(*args))
+        else:
+            future = self._executor.submit(function, *args)
+        self._pending[key] = (future, callback)
+        return True
 
+    def is_pending(self, key):
+        return key in self._pending
 
-class FPSCounter:
+    def sync(self):
+        pending, self._pending = self._pending, dict()
+        for future, callback in pending.values():
+            callback(future.result())
 
-    def __init__(self):
-        self._frames = 0
-        self._time_passed = 0
+    def shutdown(self):
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
 
-    def update(self, dt):
-        self._time_passed += dt
-        self._frames += 1
+
+class ProfilerSpan:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.add_time(self._name, (time.perf_counter() - self._start) * 1000)
+
+
+class FrameProfiler:
+
+    def __init__(self, history=PROFILER_HISTORY):
+        self._span_objects = dict()
+        self._span_names = list()
+        self._counter_names = list()
+        self._spans = dict()
+        self._counters = dict()
+        self._frames = deque(maxlen=history)
+        self._frame_start = time.perf_counter()
+        self._time_passed = 0
+        self._frames_in_second = 0
+        self._fps = 0
+        self._overlay = PROFILER_OVERLAY
+        self._font = None
+
+    def span(self, name):
+        if name not in self._span_objects:
+            self._span_objects[name] = ProfilerSpan(self, name)
+            self._span_names.append(name)
+        return self._span_objects[name]
+
+    def add_time(self, name, ms):
+        self._spans[name] = self._spans.get(name, 0.0) + ms
+
+    def count(self, name, value=1):
+        if name not in self._counters and name not in self._counter_names:
+            self._counter_names.append(name)
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_counter(self, name, value):
+        if name not in self._counters and name not in self._counter_names:
+            self._counter_names.append(name)
+        self._counters[name] = value
+
+    def end_frame(self):
+        now = time.perf_counter()
+        frame_time = (now - self._frame_start) * 1000
+        self._frame_start = now
+        self._frames.append((frame_time, self._spans, self._counters))
+        self._spans = dict()
+        self._counters = dict()
+        self._time_passed += frame_time
+        self._frames_in_second += 1
         if self._time_passed >= 1000:
+            self._fps = self._frames_in_second
             self._time_passed = 0
-            print(f'FPS: {self._frames}')
-            self._frames = 0
+            self._frames_in_second = 0
+            percentiles = self.get_percentiles()
+            print(f'FPS: {self._fps} (p50 {percentiles["p50"]:.1f} ms, p95 {percentiles["p95"]:.1f} ms, '
+                  f'p99 {percentiles["p99"]:.1f} ms)')
+
+    def _get_samples(self, name):
+        if name == 'frame':
+            return [frame[0] for frame in self._frames]
+        if name in self._span_objects:
+            return [frame[1].get(name, 0.0) for frame in self._frames]
+        return [frame[2].get(name, 0) for frame in self._frames]
+
+    def get_percentiles(self, name='frame'):
+        samples = self._get_samples(name)
+        if not samples:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+        p50, p95, p99 = np.percentile(samples, (50, 95, 99)).tolist()
+        return {'p50': p50, 'p95': p95, 'p99': p99}
+
+    def get_fps(self):
+        return self._fps
+
+    def get_summary(self):
+        return {
+            'fps': self._fps,
+            'frames': len(self._frames),
+            'frame': self.get_percentiles(),
+            'spans': {name: self.get_percentiles(name) for name in self._span_names},
+            'counters': {name: self.get_percentiles(name) for name in self._counter_names},
+        }
+
+    def export_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump({'summary': self.get_summary(),
+                       'frames': [{'frame': frame[0], 'spans': frame[1], 'counters': frame[2]}
+                                  for frame in self._frames]}, json_file, indent=2)
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['frame', *self._span_names, *self._counter_names])
+            for frame_time, spans, counters in self._frames:
+                writer.writerow([round(frame_time, 4),
+                                 *(round(spans.get(name, 0.0), 4) for name in self._span_names),
+                                 *(counters.get(name, 0) for name in self._counter_names)])
+
+    def export(self, path):
+        if path.endswith('.csv'):
+            self.export_csv(path)
+        else:
+            self.export_json(path)
+
+    def toggle_overlay(self):
+        self._overlay = not self._overlay
+
+    def is_overlay_shown(self):
+        return self._overlay
+
+    def draw_overlay(self, surface):
+        if not self._overlay:
+            return
+        if self._font is None:
+            self._font = pygame.font.Font(None, 16)
+        percentiles = self.get_percentiles()
+        lines = [f'FPS {self._fps}  p50 {percentiles["p50"]:.1f}  p95 {percentiles["p95"]:.1f}  '
+                 f'p99 {percentiles["p99"]:.1f} ms']
+        last_spans = self._frames[-1][1] if self._frames else dict()
+        last_counters = self._frames[-1][2] if self._frames else dict()
+        lines.extend(f'{name}: {last_spans.get(name, 0.0):.2f} ms' for name in self._span_names)
+        lines.extend(f'{name}: {last_counters.get(name, 0)}' for name in self._counter_names)
+        for i, line in enumerate(lines):
+            surface.blit(self._font.render(line, 1, (255, 255, 0), (0, 0, 0)), (5, 5 + i * 14))
+
+
+class SimulationClock:
+
+    def __init__(self, tick_rate=SIMULATION_TICK_RATE, max_ticks_per_frame=SIMULATION_MAX_TICKS_PER_FRAME):
+        self._tick_time = 1000 / tick_rate
+        self._max_ticks_per_frame = max_ticks_per_frame
+        self._accumulator = 0
+
+    def advance(self, dt):
+        self._accumulator += dt
+        ticks = int(self._accumulator // self._tick_time)
+        if ticks > self._max_ticks_per_frame:
+            ticks = self._max_ticks_per_frame
+            self._accumulator = ticks * self._tick_time
+        self._accumulator -= ticks * self._tick_time
+        return ticks
+
+    def get_tick_time(self):
+        return self._tick_time
+
+    def get_alpha(self):
+        return self._accumulator / self._tick_time
 
 
 class TimeLine:
@@ -49,6 +293,371 @@ class TimeLine:
         self._time += dt
 
 
+class QualityGovernor:
+
+    def __init__(self, target=QUALITY_TARGET_FRAME_TIME, window=QUALITY_WINDOW, levels=QUALITY_LEVELS,
+                 enabled=QUALITY_GOVERNOR):
+        self._target = target
+        self._frame_times = deque(maxlen=window)
+        self._levels = levels
+        self._enabled = enabled
+        self._level = 0
+
+    def add_frame_time(self, ms):
+        if not self._enabled:
+            return
+        self._frame_times.append(ms)
+        if len(self._frame_times) < self._frame_times.maxlen:
+            return
+        frame_times = sorted(self._frame_times)
+        p90 = frame_times[int(len(frame_times) * 0.9)]
+        if p90 > self._target * QUALITY_DOWNGRADE_RATIO and self._level < len(self._levels) - 1:
+            self.set_level(self._level + 1, f'p90 frame {p90:.1f} ms over target {self._target:.1f} ms')
+        elif p90 < self._target * QUALITY_UPGRADE_RATIO and self._level > 0:
+            self.set_level(self._level - 1, f'p90 frame {p90:.1f} ms leaves headroom under {self._target:.1f} ms')
+
+    def set_level(self, level, reason=None):
+        if level == self._level:
+            return
+        if reason is not None:
+            changes = ', '.join(f'{name} {value} -> {self._levels[level][name]}'
+                                for name, value in self._levels[self._level].items()
+                                if value != self._levels[level][name])
+            print(f'Quality {self._level} -> {level} ({reason}): {changes}')
+        self._level = level
+        self._frame_times.clear()
+
+    def get_level(self):
+        return self._level
+
+    def get(self, name):
+        return self._levels[self._level][name]
+
+
+class SpatialHash:
+
+    def __init__(self, cell_size=SPATIAL_HASH_CELL_SIZE, margin=WORLD_TILE_SIZE):
+        self._cell_size = cell_size
+        self._margin = margin
+        self._cells = dict()
+        self._entity_cells = dict()
+
+    def _get_cell(self, position):
+        return int(position[0] // self._cell_size), int(position[1] // self._cell_size)
+
+    def _get_cells_in_range(self, left, top, right, bottom):
+        return product(range(int((left - self._margin) // self._cell_size),
+                             int((right + self._margin) // self._cell_size) + 1),
+                       range(int((top - self._margin) // self._cell_size),
+                             int((bottom + self._margin) // self._cell_size) + 1))
+
+    def insert(self, entity):
+        cell = self._get_cell(entity.get_position())
+        self._cells.setdefault(cell, dict())[entity] = None
+        self._entity_cells[entity] = cell
+        entity.set_spatial_hash(self)
+
+    def remove(self, entity):
+        cell = self._entity_cells.pop(entity)
+        del self._cells[cell][entity]
+        if not self._cells[cell]:
+            del self._cells[cell]
+        entity.set_spatial_hash(None)
+
+    def update(self, entity):
+        old_cell, cell = self._entity_cells[entity], self._get_cell(entity.get_position())
+        if cell == old_cell:
+            return
+        del self._cells[old_cell][entity]
+        if not self._cells[old_cell]:
+            del self._cells[old_cell]
+        self._cells.setdefault(cell, dict())[entity] = None
+        self._entity_cells[entity] = cell
+
+    def query_rect(self, rect):
+        result = list()
+        for cell in self._get_cells_in_range(rect.left, rect.top, rect.right, rect.bottom):
+            bucket = self._cells.get(cell)
+            if bucket:
+                result.extend(entity for entity in bucket if rect.colliderect(entity.get_sprite().rect))
+        return result
+
+    def query_radius(self, position, radius):
+        result = list()
+        for cell in self._get_cells_in_range(position[0] - radius, position[1] - radius,
+                                             position[0] + radius, position[1] + radius):
+            bucket = self._cells.get(cell)
+            if bucket:
+                for entity in bucket:
+                    entity_position = entity.get_position()
+                    if ((entity_position[0] - position[0]) ** 2 +
+                            (entity_position[1] - position[1]) ** 2 < radius * radius):
+                        result.append(entity)
+        return result
+
+    def __contains__(self, entity):
+        return entity in self._entity_cells
+
+    def __len__(self):
+        return len(self._entity_cells)
+
+
+class EntityRegistry:
+
+    def __init__(self):
+        self._entities = list()
+        self._generations = list()
+        self._dense_positions = list()
+        self._free = list()
+        self._components = dict()
+        self._destroyed = dict()
+
+    def _get_index(self, entity_id):
+        index = entity_id & ((1 << ENTITY_INDEX_BITS) - 1)
+        if index < len(self._entities) and self._generations[index] == entity_id >> ENTITY_INDEX_BITS:
+            return index
+        return None
+
+    def create(self, entity):
+        if self._free:
+            index = self._free.pop()
+        else:
+            index = len(self._entities)
+            self._entities.append(None)
+            self._generations.append(0)
+            self._dense_positions.append(None)
+        dense = self._components.setdefault(type(entity), list())
+        self._entities[index] = entity
+        self._dense_positions[index] = len(dense)
+        dense.append(entity)
+        entity_id = self._generations[index] << ENTITY_INDEX_BITS | index
+        entity.set_id(entity_id)
+        return entity_id
+
+    def destroy(self, entity_id):
+        if self._get_index(entity_id) is not None:
+            self._destroyed[entity_id] = None
+
+    def flush(self):
+        destroyed = list()
+        for entity_id in self._destroyed:
+            index = self._get_index(entity_id)
+            entity = self._entities[index]
+            dense = self._components[type(entity)]
+            last = dense.pop()
+            if last is not entity:
+                position = self._dense_positions[index]
+                dense[position] = last
+                self._dense_positions[self._get_index(last.get_id())] = position
+            self._entities[index] = None
+            self._dense_positions[index] = None
+            self._generations[index] += 1
+            self._free.append(index)
+            entity.set_id(None)
+            destroyed.append(entity)
+        self._destroyed.clear()
+        return destroyed
+
+    def get(self, entity_id):
+        index = self._get_index(entity_id)
+        return None if index is None else self._entities[index]
+
+    def is_alive(self, entity_id):
+        return self._get_index(entity_id) is not None and entity_id not in self._destroyed
+
+    def _get_dense_lists(self, kinds):
+        return [dense for kind, dense in self._components.items() if not kinds or issubclass(kind, kinds)]
+
+    def iterate(self, *kinds):
+        return chain.from_iterable(self._get_dense_lists(kinds))
+
+    def count(self, *kinds):
+        return sum(map(len, self._get_dense_lists(kinds)))
+
+    def __len__(self):
+        return len(self._entities) - len(self._free)
+
+
+class AIScheduler:
+
+    def __init__(self, budget=ENEMY_AI_BUDGET, near_interval=ENEMY_NEAR_UPDATE_INTERVAL):
+        self._budget = budget
+        self._near_interval = near_interval
+        self._budget_left = budget
+        self._tick = 0
+
+    def set_limits(self, budget, near_interval):
+        self._budget = budget
+        self._near_interval = near_interval
+
+    def begin_tick(self):
+        self._tick += 1
+        self._budget_left = self._budget
+
+    def get_interval(self, active):
+        return 1 if active else self._near_interval
+
+    def is_due(self, entity_id, active):
+        return (self._tick + entity_id) % self.get_interval(active) == 0
+
+    def take_budget(self):
+        if self._budget_left <= 0:
+            return False
+        self._budget_left -= 1
+        return True
+
+    def get_tick(self):
+        return self._tick
+
+
+class TextureManager:
+
+    def __init__(self):
+        self._textures = dict()
+        self._ref_counts = dict()
+        self._atlas = None
+        self._atlas_keys = set()
+
+    def _load(self, name, size, colorkey):
+        image = pygame.image.load(os.path.join('resources', 'textures', f'{name}.png'))
+        if pygame.display.get_surface() is not None:
+            image = image.convert()
+        if size is not None and image.get_size() != size:
+            image = pygame.transform.scale(image, size)
+        if colorkey is not None:
+            image.set_colorkey(colorkey)
+        return image
+
+    def get(self, name, size=None, colorkey=None):
+        key = (name, size, colorkey)
+        if key not in self._textures:
+            self._textures[key] = self._load(name, size, colorkey)
+            self._ref_counts[key] = 0
+        self._ref_counts[key] += 1
+        return self._textures[key]
+
+    def release(self, name, size=None, colorkey=None):
+        key = (name, size, colorkey)
+        if self._ref_counts.get(key, 0) > 0:
+            self._ref_counts[key] -= 1
+
+    def evict_unused(self):
+        for key in [k for k, count in self._ref_counts.items() if count == 0 and k not in self._atlas_keys]:
+            del self._textures[key]
+            del self._ref_counts[key]
+
+    def build_atlas(self, textures=(), max_width=1024):
+        for key in textures:
+            if key not in self._textures:
+                self._textures[key] = self._load(*key)
+                self._ref_counts[key] = 0
+        keys = sorted(self._textures, key=lambda k: -self._textures[k].get_height())
+        places = dict()
+        x = y = shelf_height = atlas_width = 0
+        for key in keys:
+            w, h = self._textures[key].get_size()
+            if x + w > max_width and x > 0:
+                x, y = 0, y + shelf_height
+                shelf_height = 0
+            places[key] = pygame.Rect(x, y, w, h)
+            x += w
+            shelf_height = max(shelf_height, h)
+            atlas_width = max(atlas_width, x)
+        self._atlas = pygame.Surface((max(atlas_width, 1), max(y + shelf_height, 1)))
+        if pygame.display.get_surface() is not None:
+            self._atlas = self._atlas.convert()
+        for key in keys:
+            pixels = self._textures[key].copy()
+            pixels.set_colorkey(None)
+            self._atlas.blit(pixels, places[key])
+            texture = self._atlas.subsurface(places[key])
+            if key[2] is not None:
+                texture.set_colorkey(key[2])
+            self._textures[key] = texture
+        self._atlas_keys = set(keys)
+        return self._atlas
+
+    def get_atlas(self):
+        return self._atlas
+
+
+class TextCache:
+
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self._fonts = dict()
+        self._texts = OrderedDict()
+        self._max_size = max_size
+
+    def get_font(self, size):
+        if size not in self._fonts:
+            self._fonts[size] = pygame.font.Font(None, size)
+        return self._fonts[size]
+
+    def render(self, text, color, size):
+        key = (text, color, size)
+        text_surface = self._texts.get(key)
+        if text_surface is None:
+            text_surface = self._texts[key] = self.get_font(size).render(text, 1, color)
+            if len(self._texts) > self._max_size:
+                self._texts.popitem(last=False)
+        else:
+            self._texts.move_to_end(key)
+        return text_surface
+
+
+class HUDWidget:
+
+    def __init__(self, label, color, position, size=18):
+        self._label = label
+        self._color = color
+        self._position = position
+        self._size = size
+        self._value = None
+        self._surface = None
+
+    def set_value(self, value):
+        if self._surface is not None and value == self._value:
+            return False
+        self._value = value
+        self._surface = text_cache.render(self._label + str(value), self._color, self._size)
+        return True
+
+    def get_rect(self):
+        return pygame.Rect(self._position, self._surface.get_size())
+
+    def get_surface(self):
+        return self._surface
+
+
+class HUD:
+
+    def __init__(self):
+        self._widgets = dict()
+        self._overlay = None
+        self._overlay_position = (0, 0)
+
+    def add_widget(self, name, widget):
+        self._widgets[name] = widget
+        self._overlay = None
+
+    def set_value(self, name, value):
+        if self._widgets[name].set_value(value):
+            self._overlay = None
+
+    def _build_overlay(self):
+        rects = [widget.get_rect() for widget in self._widgets.values()]
+        bounds = rects[0].unionall(rects[1:])
+        self._overlay = pygame.Surface(bounds.size, pygame.SRCALPHA)
+        for widget, rect in zip(self._widgets.values(), rects):
+            self._overlay.blit(widget.get_surface(), (rect.x - bounds.x, rect.y - bounds.y))
+        self._overlay_position = bounds.topleft
+
+    def draw(self, surface):
+        if self._overlay is None:
+            self._build_overlay()
+        return surface.blit(self._overlay, self._overlay_position)
+
+
 class Camera:
 
     def __init__(self, canvas_size, screen_size, position):
@@ -71,9 +680,13 @@ class Camera:
 
 class LightSource:
 
-    def __init__(self, position):
+    def __init__(self, position, radius=LIGHT_SOURCE_RADIUS, intensity=1.0, static=False):
         self._old_position = (0, 0)
         self._new_position = position
+        self._radius = radius
+        self._intensity = intensity
+        self._static = static
+        self._dirty = True
 
     def set_position(self, position):
         self._new_position = position
@@ -83,6 +696,13 @@ class LightSource:
 
     def update(self):
         self._old_position = self._new_position
+        self._dirty = False
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def is_dirty(self):
+        return self._dirty
 
     def get_new_position(self):
         return self._new_position
@@ -90,31 +710,77 @@ class LightSource:
     def get_old_position(self):
         return self._old_position
 
+    def get_radius(self):
+        return self._radius
+
+    def get_intensity(self):
+        return self._intensity
+
+    def is_static(self):
+        return self._static
+
 
 class Entity:
 
     def __init__(self, position, sprite_texture_name):
         self._sprite = pygame.sprite.Sprite()
-        self._sprite.image = pygame.image.load(os.path.join('resources', 'textures', f'{sprite_texture_name}.png')).convert()
-        self._sprite.image.set_colorkey((255, 255, 255))
+        self._texture_name = sprite_texture_name
+        self._sprite.image = texture_manager.get(sprite_texture_name, colorkey=(255, 255, 255))
         # self._sprite.image = pygame.transform.scale(self._sprite.image, (PLAYER_SPRITE_SIZE, PLAYER_SPRITE_SIZE))
         self._sprite.rect = self._sprite.image.get_rect(center=(position[0], position[1]))
         self._position = position
+        self._previous_position = position
+        self._move_time = None
+        self._spatial_hash = None
+        self._id = None
+
+    def set_id(self, entity_id):
+        self._id = entity_id
+
+    def get_id(self):
+        return self._id
 
     def set_position(self, position):
         self._sprite.rect.center = tuple(map(round, position))
         self._position = position
+        self._previous_position = position
+        self._move_time = time_line.get_time()
+        if self._spatial_hash is not None:
+            self._spatial_hash.update(self)
 
     def move(self, delta):
-        self._position = tuple(map(lambda x: x[0] + x[1], zip(self._position, delta)))
-        self._sprite.rect.center = tuple(map(round, self._position))
+        if self._move_time != time_line.get_time():
+            self._previous_position = self._position
+            self._move_time = time_line.get_time()
+        self._position = (self._position[0] + delta[0], self._position[1] + delta[1])
+        self._sprite.rect.center = (round(self._position[0]), round(self._position[1]))
+        if self._spatial_hash is not None:
+            self._spatial_hash.update(self)
+
+    def set_spatial_hash(self, spatial_hash):
+        self._spatial_hash = spatial_hash
+
+    def get_spatial_hash(self):
+        return self._spatial_hash
 
     def get_position(self):
         return self._position
 
+    def get_interpolated_position(self, alpha):
+        if self._move_time != time_line.get_time():
+            return self._position
+        return (self._previous_position[0] + (self._position[0] - self._previous_position[0]) * alpha,
+                self._previous_position[1] + (self._position[1] - self._previous_position[1]) * alpha)
+
     def get_sprite(self):
         return self._sprite
 
+    def get_size(self):
+        return self._sprite.rect.size
+
+    def release_texture(self):
+        texture_manager.release(self._texture_name, colorkey=(255, 255, 255))
+
 
 class Key(Entity):
 
@@ -122,16 +788,6 @@ class Key(Entity):
         super().__init__(position, 'key')
 
 
-class Bullet(Entity):
-
-    def __init__(self, position, velocity):
-        super().__init__(position, 'bullet')
-        self._velocity = velocity
-
-    def get_velocity(self):
-        return self._velocity
-
-
 class Mob(Entity):
 
     def __init__(self, position, sprite_texture_name, health):
@@ -172,9 +828,8 @@ class Player(Mob):
         vel = (point_pos[0] - self.get_position()[0], point_pos[1] - self.get_position()[1])
         dist = (vel[0] ** 2 + vel[1] ** 2) ** 0.5
         vel = (vel[0] * BULLET_SPEED / dist, vel[1] * BULLET_SPEED / dist)
-        bullet = Bullet(self.get_position(), vel)
         self._attack_time = time_line.get_time()
-        return bullet
+        return self.get_position(), vel
 
 
 class Enemy(Mob):
@@ -182,6 +837,18 @@ class Enemy(Mob):
     def __init__(self, position):
         super().__init__(position, 'enemy', 3)
         self._attack_time = 0
+        self._direction = None
+        self._decision_tick = -1
+
+    def set_decision(self, direction, tick):
+        self._direction = direction
+        self._decision_tick = tick
+
+    def get_direction(self):
+        return self._direction
+
+    def get_decision_tick(self):
+        return self._decision_tick
 
     def attack(self):
         self._attack_time = time_line.get_time()
@@ -190,286 +857,987 @@ class Enemy(Mob):
         return time_line.get_time() - self._attack_time >= ENEMY_ATTACK_PERIOD
 
 
-class GameWorldTile:
+TILE_FLOOR = 0
+TILE_WALL = 1
 
-    def __init__(self, world_position, type, darkness=1.0):  # types: 0 - floor, 1 - wall
-        self._type = type
-        self._sprite = pygame.sprite.Sprite()
-        self._sprite.image = pygame.image.load(os.path.join('resources', 'textures', 'tile' + str(type) + '.png'))
-        self._sprite.image = pygame.transform.scale(self._sprite.image, (WORLD_TILE_SIZE, WORLD_TILE_SIZE))
-        self._sprite.rect = self._sprite.image.get_rect(center=(int((world_position[0] + 0.5) * WORLD_TILE_SIZE),
-                                                                int((world_position[1] + 0.5) * WORLD_TILE_SIZE)))
-        self._darkness = darkness
+SHADOWCAST_OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+                      (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
 
-        self._surface_to_draw = pygame.Surface((WORLD_TILE_SIZE, WORLD_TILE_SIZE))
-        self._surface_to_draw.fill((0, 0, 0))
-        self._surface_to_draw.set_alpha(round(self._darkness * 25))
 
-    def draw_light_mask(self, surface):
-        self._surface_to_draw.set_alpha(round(self._darkness * 255))
-        pos = self._sprite.rect.center[0] - WORLD_TILE_SIZE // 2, self._sprite.rect.center[1] - WORLD_TILE_SIZE // 2
-        surface.blit(self._surface_to_draw, pos)
+def get_window_slices(center, radius, size):
+    x0, y0 = center[0] - radius, center[1] - radius
+    gx0, gy0 = max(x0, 0), max(y0, 0)
+    gx1, gy1 = min(center[0] + radius + 1, size[0]), min(center[1] + radius + 1, size[1])
+    return ((slice(gx0, max(gx1, gx0)), slice(gy0, max(gy1, gy0))),
+            (slice(gx0 - x0, max(gx1, gx0) - x0), slice(gy0 - y0, max(gy1, gy0) - y0)))
 
-    def set_darkness(self, darkness):
-        self._darkness = darkness
 
-    def get_sprite(self):
-        return self._sprite
+def get_light_falloff(radius):
+    offsets = np.arange(-radius, radius + 1)
+    dist = np.hypot(*np.meshgrid(offsets, offsets, indexing='ij'))
+    return np.clip(2 / (dist + 0.001) - 2 / radius, 0.0, 1.0).astype(np.float32)
+
+
+def add_light_patch(light, center, patch, scale=1.0):
+    global_window, local_window = get_window_slices(center, patch.shape[0] // 2, light.shape)
+    light[global_window] += patch[local_window] * scale
+
+
+def cast_light(walls, visible, radius, row, start, end, xx, xy, yx, yy):
+    if start < end:
+        return
+    new_start = start
+    for j in range(row, radius + 1):
+        dx, dy = -j - 1, -j
+        blocked = False
+        while dx <= 0:
+            dx += 1
+            x, y = radius + dx * xx + dy * xy, radius + dx * yx + dy * yy
+            l_slope, r_slope = (dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5)
+            if start < r_slope:
+                continue
+            elif end > l_slope:
+                break
+            if dx * dx + dy * dy < radius * radius:
+                visible[x][y] = True
+            if blocked:
+                if walls[x][y]:
+                    new_start = r_slope
+                else:
+                    blocked = False
+                    start = new_start
+            elif walls[x][y] and j < radius:
+                blocked = True
+                cast_light(walls, visible, radius, j + 1, start, l_slope, xx, xy, yx, yy)
+                new_start = r_slope
+        if blocked:
+            break
+
+
+def compute_light_patch(walls, radius, falloff):
+    size = 2 * radius + 1
+    visible = [[False] * size for _ in range(size)]
+    visible[radius][radius] = True
+    for octant in SHADOWCAST_OCTANTS:
+        cast_light(walls, visible, radius, 1, 1.0, 0.0, *octant)
+    return np.where(visible, falloff, 0.0).astype(np.float32)
+
+
+def compute_distance_field(walls, size, target, max_distance):
+    size_x, size_y = size
+    distances = [-1] * (size_x * size_y)
+    start = target[0] * size_y + target[1]
+    if not (0 <= target[0] < size_x and 0 <= target[1] < size_y) or walls[start]:
+        return distances
+    distances[start] = 0
+    queue = deque((start,))
+    while queue:
+        index = queue.popleft()
+        distance = distances[index] + 1
+        if max_distance is not None and distance > max_distance:
+            continue
+        x, y = divmod(index, size_y)
+        for neighbour, inside in ((index + 1, y + 1 < size_y), (index - 1, y > 0),
+                                  (index + size_y, x + 1 < size_x), (index - size_y, x > 0)):
+            if inside and distances[neighbour] == -1 and not walls[neighbour]:
+                distances[neighbour] = distance
+                queue.append(neighbour)
+    return distances
+
+
+class ShadowCaster:
+
+    def __init__(self, tile_types, radius):
+        self._tile_types = tile_types
+        self._radius = radius
+        self._falloff = get_light_falloff(radius)
+
+    def get_radius(self):
+        return self._radius
+
+    def get_falloff(self):
+        return self._falloff
+
+    def get_walls(self, origin):
+        size = 2 * self._radius + 1
+        global_window, local_window = get_window_slices(origin, self._radius, self._tile_types.shape)
+        walls = np.ones((size, size), dtype=bool)
+        walls[local_window] = self._tile_types[global_window] == TILE_WALL
+        return walls.tolist()
+
+    def compute(self, origin):
+        return compute_light_patch(self.get_walls(origin), self._radius, self._falloff)
+
+
+class FlowField:
+
+    def __init__(self, tile_types, max_distance=None):
+        self._tile_types = tile_types
+        self._size = tile_types.shape
+        self._max_distance = max_distance
+        self._walls = None
+        self._generation = 0
+        self._requested_target = None
+        self._target = None
+        self._origin = (0, 0)
+        self._window_size = (0, 0)
+        self._distances = list()
+
+    def invalidate(self):
+        self._walls = None
+        self._requested_target = None
+        self._generation += 1
+
+    def _get_walls_window(self, target):
+        if self._max_distance is None:
+            if self._walls is None:
+                self._walls = (self._tile_types == TILE_WALL).ravel().tolist()
+            return self._walls, (0, 0), self._size
+        window = get_window_slices(target, self._max_distance, self._size)[0]
+        walls = self._tile_types[window] == TILE_WALL
+        return walls.ravel().tolist(), (window[0].start, window[1].start), walls.shape
+
+    def update(self, target):
+        if target == self._requested_target or job_system.is_pending(self):
+            return False
+        self._requested_target = target
+        walls, origin, window_size = self._get_walls_window(target)
+        job_system.submit(self, partial(self._apply, target, origin, window_size, self._generation),
+                          compute_distance_field, walls, window_size,
+                          (target[0] - origin[0], target[1] - origin[1]), self._max_distance)
+        return True
+
+    def _apply(self, target, origin, window_size, generation, distances):
+        if generation != self._generation:
+            return
+        self._target = target
+        self._origin = origin
+        self._window_size = window_size
+        self._distances = distances
+
+    def get_distance(self, tile):
+        x, y = tile[0] - self._origin[0], tile[1] - self._origin[1]
+        if not (0 <= x < self._window_size[0] and 0 <= y < self._window_size[1]):
+            return -1
+        return self._distances[x * self._window_size[1] + y]
+
+    def get_next_step(self, tile):
+        distance = self.get_distance(tile)
+        if distance <= 0:
+            return None
+        for step in ((tile[0], tile[1] + 1), (tile[0], tile[1] - 1), (tile[0] + 1, tile[1]), (tile[0] - 1, tile[1])):
+            if self.get_distance(step) == distance - 1:
+                return step
+        return None
+
+
+class LineOfSight:
+
+    def __init__(self, tile_types, bitmap=None, cache_size=LINE_OF_SIGHT_CACHE_SIZE):
+        self._tile_types = tile_types
+        self._size = tile_types.shape
+        self._cache_size = cache_size
+        self._cache = dict()
+        self._bitmap = bitmap
+
+    def invalidate(self):
+        self._bitmap = None
+        self._cache.clear()
+
+    def _trace(self, a, b):
+        bitmap, size_y = self._bitmap, self._size[1]
+        x, y = a
+        dx, dy = abs(b[0] - x), -abs(b[1] - y)
+        sx, sy = (1 if x < b[0] else -1), (1 if y < b[1] else -1)
+        err = dx + dy
+        while True:
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x += sx
+            if e2 <= dx:
+                err += dx
+                y += sy
+            if x == b[0] and y == b[1]:
+                return True
+            index = x * size_y + y
+            if bitmap[index >> 3] >> (7 - (index & 7)) & 1:
+                return False
+
+    def is_clear(self, a, b):
+        if a == b:
+            return True
+        if b < a:
+            a, b = b, a
+        result = self._cache.get((a, b))
+        if result is not None:
+            return result
+        if not (0 <= a[0] < self._size[0] and 0 <= a[1] < self._size[1] and
+                0 <= b[0] < self._size[0] and 0 <= b[1] < self._size[1]):
+            return False
+        if self._bitmap is None:
+            self._bitmap = np.packbits(self._tile_types == TILE_WALL, axis=None).tobytes()
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        result = self._cache[(a, b)] = self._trace(a, b)
+        return result
+
+
+class TileCollider:
+
+    def __init__(self, tile_types):
+        self._tile_types = tile_types
+        self._size = tile_types.shape
+
+    def _is_blocked(self, left, top, right, bottom):
+        x0, y0 = math.floor(left / WORLD_TILE_SIZE), math.floor(top / WORLD_TILE_SIZE)
+        x1, y1 = math.ceil(right / WORLD_TILE_SIZE), math.ceil(bottom / WORLD_TILE_SIZE)
+        if x0 < 0 or y0 < 0 or x1 > self._size[0] or y1 > self._size[1]:
+            return True
+        tile_types = self._tile_types
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                if tile_types.item(x, y) == TILE_WALL:
+                    return True
+        return False
+
+    def resolve(self, position, size, move):
+        half_w, half_h = size[0] / 2, size[1] / 2
+        x, y = position
+        move_x, move_y = move
+        if move_x and self._is_blocked(min(x, x + move_x) - half_w, y - half_h,
+                                       max(x, x + move_x) + half_w, y + half_h):
+            move_x = 0
+        x += move_x
+        if move_y and self._is_blocked(x - half_w, min(y, y + move_y) - half_h,
+                                       x + half_w, max(y, y + move_y) + half_h):
+            move_y = 0
+        return move_x, move_y
+
+    def resolve_batch(self, positions, sizes, moves):
+        result = np.array(moves, dtype=np.float64)
+        half_sizes = np.asarray(sizes, dtype=np.float64) / 2
+        positions = np.array(positions, dtype=np.float64)
+        for axis in (0, 1):
+            start, end = positions[:, axis], positions[:, axis] + result[:, axis]
+            low, high = positions - half_sizes, positions + half_sizes
+            low[:, axis] = np.minimum(start, end) - half_sizes[:, axis]
+            high[:, axis] = np.maximum(start, end) + half_sizes[:, axis]
+            blocked = self._are_blocked(low, high) & (result[:, axis] != 0)
+            result[blocked, axis] = 0
+            positions[:, axis] += result[:, axis]
+        return result
+
+    def _are_blocked(self, low, high):
+        first = np.floor(low / WORLD_TILE_SIZE).astype(np.int64)
+        last = np.ceil(high / WORLD_TILE_SIZE).astype(np.int64)
+        blocked = (first < 0).any(axis=1) | (last[:, 0] > self._size[0]) | (last[:, 1] > self._size[1])
+        if not len(first):
+            return blocked
+        spans = last - first
+        for i, j in product(range(int(spans[:, 0].max())), range(int(spans[:, 1].max()))):
+            x, y = first[:, 0] + i, first[:, 1] + j
+            inside = (i < spans[:, 0]) & (j < spans[:, 1]) & ~blocked
+            blocked[inside] |= self._tile_types[x[inside], y[inside]] == TILE_WALL
+        return blocked
+
+
+class BulletSystem:
+
+    def __init__(self, tile_collider, capacity=BULLET_POOL_SIZE):
+        self._tile_collider = tile_collider
+        self._texture = texture_manager.get('bullet', colorkey=(255, 255, 255))
+        self._size = self._texture.get_size()
+        self._positions = np.zeros((capacity, 2))
+        self._previous_positions = np.zeros((capacity, 2))
+        self._velocities = np.zeros((capacity, 2))
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def _grow(self):
+        capacity = len(self._alive)
+        self._positions = np.concatenate((self._positions, np.zeros((capacity, 2))))
+        self._previous_positions = np.concatenate((self._previous_positions, np.zeros((capacity, 2))))
+        self._velocities = np.concatenate((self._velocities, np.zeros((capacity, 2))))
+        self._alive = np.concatenate((self._alive, np.zeros(capacity, dtype=bool)))
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def spawn(self, position, velocity):
+        if not self._free:
+            self._grow()
+        index = self._free.pop()
+        self._positions[index] = position
+        self._previous_positions[index] = position
+        self._velocities[index] = velocity
+        self._alive[index] = True
+        return index
+
+    def kill(self, index):
+        if self._alive[index]:
+            self._alive[index] = False
+            self._free.append(index)
+
+    def save_positions(self):
+        self._previous_positions[self._alive] = self._positions[self._alive]
+
+    def update(self, dt, enemy_index):
+        hit_enemies = list()
+        alive = np.flatnonzero(self._alive)
+        if not len(alive):
+            return hit_enemies
+        moves = self._velocities[alive] * (dt / 1000)
+        resolved = self._tile_collider.resolve_batch(self._positions[alive], np.broadcast_to(self._size, moves.shape),
+                                                     moves)
+        hit_wall = (resolved != moves).any(axis=1)
+        for index in alive[hit_wall].tolist():
+            self.kill(index)
+        flying = alive[~hit_wall]
+        self._positions[flying] += moves[~hit_wall]
+        rect = pygame.Rect((0, 0), self._size)
+        for index, position in zip(flying.tolist(), self._positions[flying].tolist()):
+            rect.center = (round(position[0]), round(position[1]))
+            enemies = enemy_index.query_rect(rect)
+            if enemies:
+                hit_enemies.append(enemies[0])
+                self.kill(index)
+        return hit_enemies
+
+    def get_tiles(self):
+        return (self._positions[self._alive] // WORLD_TILE_SIZE).astype(np.int64)
+
+    def get_blits(self, alpha=1.0, offset=(0, 0)):
+        previous_positions = self._previous_positions[self._alive]
+        positions = previous_positions + (self._positions[self._alive] - previous_positions) * alpha
+        corners = np.rint(positions - np.divide(self._size, 2) - offset).astype(np.int64).tolist()
+        return [(self._texture, corner) for corner in corners]
+
+    def __len__(self):
+        return len(self._alive) - len(self._free)
+
+
+MAP_FILE_MAGIC = b'YLMP'
+MAP_FILE_VERSION = 2
+MAP_FILE_HEADER = struct.Struct('<4sHHIIHHiiIIIQQQQQQ')
+MAP_FILE_ALIGNMENT = 8
+
+
+class MapData:
+
+    def __init__(self, tile_types, player_start, key_tiles, enemy_tiles, torch_tiles, wall_bitmap=None,
+                 chunk_index=None):
+        self._tile_types = tile_types
+        self._player_start = player_start
+        self._key_tiles = key_tiles
+        self._enemy_tiles = enemy_tiles
+        self._torch_tiles = torch_tiles
+        self._wall_bitmap = wall_bitmap
+        self._chunk_index = chunk_index
+        self._mmap = None
+
+    @staticmethod
+    def from_image(map_image_path):
+        map_pixels = np.asarray(Image.open(map_image_path).convert('RGB')).transpose(1, 0, 2)
+        r, g, b = map_pixels[:, :, 0], map_pixels[:, :, 1], map_pixels[:, :, 2]
+        tile_types = np.full(map_pixels.shape[:2], TILE_FLOOR, dtype=np.uint8)
+        tile_types[(r == 255) & (g == 255) & (b == 255)] = TILE_WALL
+        player_tiles = np.argwhere((r == 0) & (g == 255) & (b == 0))
+        player_start = (0, 0)
+        if len(player_tiles):
+            player_start = (int(player_tiles[-1][0]) * WORLD_TILE_SIZE, int(player_tiles[-1][1]) * WORLD_TILE_SIZE)
+        return MapData(tile_types, player_start,
+                       np.argwhere((r == 0) & (g == 0) & (b == 255)).astype(np.int32),
+                       np.argwhere((r == 255) & (g == 0) & (b == 0)).astype(np.int32),
+                       np.argwhere((r == 255) & (g == 255) & (b == 0)).astype(np.int32))
+
+    @staticmethod
+    def load(map_path):
+        with open(map_path, 'rb') as map_file:
+            buffer = mmap.mmap(map_file.fileno(), 0, access=mmap.ACCESS_COPY)
+        (magic, version, _, size_x, size_y, chunk_w, chunk_h, player_x, player_y, keys_count, enemies_count,
+         torches_count, tiles_offset, walls_offset, keys_offset, enemies_offset, torches_offset,
+         chunks_offset) = MAP_FILE_HEADER.unpack_from(buffer)
+        if magic != MAP_FILE_MAGIC or version != MAP_FILE_VERSION:
+            raise ValueError(f'{map_path} is not a compiled map of version {MAP_FILE_VERSION}')
+        chunks_count = math.ceil(size_x / chunk_w) * math.ceil(size_y / chunk_h)
+        map_data = MapData(
+            np.frombuffer(buffer, np.uint8, size_x * size_y, tiles_offset).reshape(size_x, size_y),
+            (player_x, player_y),
+            np.frombuffer(buffer, np.int32, keys_count * 2, keys_offset).reshape(keys_count, 2),
+            np.frombuffer(buffer, np.int32, enemies_count * 2, enemies_offset).reshape(enemies_count, 2),
+            np.frombuffer(buffer, np.int32, torches_count * 2, torches_offset).reshape(torches_count, 2),
+            memoryview(buffer)[walls_offset:walls_offset + math.ceil(size_x * size_y / 8)],
+            ((chunk_w, chunk_h), np.frombuffer(buffer, np.int32, chunks_count * 4, chunks_offset).reshape(-1, 4)))
+        map_data._mmap = buffer
+        return map_data
+
+    def save(self, map_path, chunk_size):
+        size_x, size_y = self._tile_types.shape
+        chunks = np.array([(x, y, min(x + chunk_size[0], size_x), min(y + chunk_size[1], size_y))
+                           for x, y in product(range(0, size_x, chunk_size[0]), range(0, size_y, chunk_size[1]))],
+                          dtype=np.int32)
+        sections = [np.ascontiguousarray(self._tile_types, dtype=np.uint8).tobytes(),
+                    np.packbits(self._tile_types == TILE_WALL, axis=None).tobytes(),
+                    np.ascontiguousarray(self._key_tiles, dtype=np.int32).tobytes(),
+                    np.ascontiguousarray(self._enemy_tiles, dtype=np.int32).tobytes(),
+                    np.ascontiguousarray(self._torch_tiles, dtype=np.int32).tobytes(),
+                    chunks.tobytes()]
+        offsets, position = list(), MAP_FILE_HEADER.size
+        for section in sections:
+            position = -(-position // MAP_FILE_ALIGNMENT) * MAP_FILE_ALIGNMENT
+            offsets.append(position)
+            position += len(section)
+        with open(map_path, 'wb') as map_file:
+            map_file.write(MAP_FILE_HEADER.pack(MAP_FILE_MAGIC, MAP_FILE_VERSION, 0, size_x, size_y, *chunk_size,
+                                                *self._player_start, len(self._key_tiles), len(self._enemy_tiles),
+                                                len(self._torch_tiles), *offsets))
+            for offset, section in zip(offsets, sections):
+                map_file.write(bytes(offset - map_file.tell()))
+                map_file.write(section)
+
+    def get_tile_types(self):
+        return self._tile_types
+
+    def get_player_start_position(self):
+        return self._player_start
+
+    def get_key_tiles(self):
+        return self._key_tiles
+
+    def get_enemy_tiles(self):
+        return self._enemy_tiles
+
+    def get_torch_tiles(self):
+        return self._torch_tiles
+
+    def get_wall_bitmap(self):
+        return self._wall_bitmap
+
+    def get_chunk_index(self):
+        return self._chunk_index
 
-    def get_type(self):
-        return self._type
+
+def compile_map(map_image_path, map_path=None, screen_size=DISPLAY_SIZE):
+    if map_path is None:
+        map_path = os.path.splitext(map_image_path)[0] + WORLD_MAP_COMPILED_EXTENSION
+    chunk_size = (math.ceil(screen_size[0] / WORLD_TILE_SIZE), math.ceil(screen_size[1] / WORLD_TILE_SIZE))
+    MapData.from_image(map_image_path).save(map_path, chunk_size)
+    return map_path
+
+
+def is_compiled_map_current(map_path):
+    with open(map_path, 'rb') as map_file:
+        header = map_file.read(MAP_FILE_HEADER.size)
+    return len(header) == MAP_FILE_HEADER.size and MAP_FILE_HEADER.unpack(header)[:2] == (MAP_FILE_MAGIC,
+                                                                                         MAP_FILE_VERSION)
+
+
+def get_compiled_map_path(map_image_path):
+    if map_image_path.endswith(WORLD_MAP_COMPILED_EXTENSION):
+        return map_image_path
+    map_path = os.path.splitext(map_image_path)[0] + WORLD_MAP_COMPILED_EXTENSION
+    if (not os.path.exists(map_path) or os.path.getmtime(map_path) < os.path.getmtime(map_image_path) or
+            not is_compiled_map_current(map_path)):
+        try:
+            compile_map(map_image_path, map_path)
+        except OSError:
+            return map_image_path
+    return map_path
 
 
 class GameWorld:
 
-    def __init__(self, map_image_path, screen_size):
-        map_image = Image.open(map_image_path)
-        self._size = map_image.size
-        self._tiles = [[None] * self._size[1] for _ in range(self._size[0])]
+    def __init__(self, map_path, screen_size):
+        if map_path.endswith(WORLD_MAP_COMPILED_EXTENSION):
+            map_data = MapData.load(map_path)
+        else:
+            map_data = MapData.from_image(map_path)
+        self._map_data = map_data
+        self._tile_types = map_data.get_tile_types()
+        self._size = self._tile_types.shape
+        self._darkness = np.ones(self._size, dtype=np.float32)
+        self._static_light = np.zeros(self._size, dtype=np.float32)
         scr_sz_t = (math.ceil(screen_size[0] / WORLD_TILE_SIZE), math.ceil(screen_size[1] / WORLD_TILE_SIZE))
-        self._tile_chunks = [[list() for __ in range(math.ceil(self._size[1] / scr_sz_t[1]))]
-                             for _ in range(math.ceil(self._size[0] / scr_sz_t[0]))]
+        chunk_index = map_data.get_chunk_index()
+        if chunk_index is not None and chunk_index[0] == scr_sz_t:
+            chunks_y = math.ceil(self._size[1] / scr_sz_t[1])
+            bounds = [tuple(chunk) for chunk in chunk_index[1].tolist()]
+            self._tile_chunks = [bounds[x:x + chunks_y] for x in range(0, len(bounds), chunks_y)]
+        else:
+            self._tile_chunks = [[(x * scr_sz_t[0], y * scr_sz_t[1],
+                                   min((x + 1) * scr_sz_t[0], self._size[0]), min((y + 1) * scr_sz_t[1], self._size[1]))
+                                  for y in range(math.ceil(self._size[1] / scr_sz_t[1]))]
+                                 for x in range(math.ceil(self._size[0] / scr_sz_t[0]))]
         self._chunk_size_tiles = scr_sz_t
-        self._keys = list()
-        self._enemies = list()
-        self._bullets = list()
-        self._player_start_position = (0, 0)
-        self._entity_sprite_group = pygame.sprite.Group()
-        for x, y in product(*map(range, self._size)):
-            tile_color = map_image.getpixel((x, y))
-            tl_chk_xy = (x // scr_sz_t[0], y // scr_sz_t[1])
-            if tile_color[0] == tile_color[1] == tile_color[2] == 255:
-                self._tiles[x][y] = GameWorldTile((x, y), 1)
-                self._tile_chunks[tl_chk_xy[0]][tl_chk_xy[1]].append(self._tiles[x][y])
-            elif tile_color[0] == tile_color[1] == tile_color[2] == 0:
-                self._tiles[x][y] = GameWorldTile((x, y), 0)
-                self._tile_chunks[tl_chk_xy[0]][tl_chk_xy[1]].append(self._tiles[x][y])
-            elif tile_color[0] == tile_color[2] == 0 and tile_color[1] == 255:
-                self._tiles[x][y] = GameWorldTile((x, y), 0)
-                self._tile_chunks[tl_chk_xy[0]][tl_chk_xy[1]].append(self._tiles[x][y])
-                self._player_start_position = (x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE)
-            elif tile_color[0] == tile_color[1] == 0 and tile_color[2] == 255:
-                self._tiles[x][y] = GameWorldTile((x, y), 0)
-                self._tile_chunks[tl_chk_xy[0]][tl_chk_xy[1]].append(self._tiles[x][y])
-                self._keys.append(Key((x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE)))
-                self._entity_sprite_group.add(self._keys[-1].get_sprite())
-            elif tile_color[0] == 255 and tile_color[1] == tile_color[2] == 0:
-                self._tiles[x][y] = GameWorldTile((x, y), 0)
-                self._tile_chunks[tl_chk_xy[0]][tl_chk_xy[1]].append(self._tiles[x][y])
-                self.add_enemy(Enemy((x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE)))
-        self._light_sources = list()
+        self._chunk_surfaces = OrderedDict()
+        self._tile_textures = [texture_manager.get('tile' + str(tile_type), size=(WORLD_TILE_SIZE, WORLD_TILE_SIZE))
+                               for tile_type in (TILE_FLOOR, TILE_WALL)]
+        self._light_mask = None
+        self._scaled_light_mask = None
+        self._light_view = None
+        self._light_mask_age = 0
+        self._last_draw_offset = None
+        self._last_quality_level = None
+        self._last_entity_rects = set()
+        self._dirty_light_windows = list()
+        self._player_start_position = map_data.get_player_start_position()
+        self._entities = EntityRegistry()
+        self._unindexed_entities = dict()
+        self._enemy_index = SpatialHash()
+        self._key_index = SpatialHash()
+        self._ai_scheduler = AIScheduler()
+        for x, y in map_data.get_key_tiles().tolist():
+            self.add_key(Key((x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE)))
+        for x, y in map_data.get_enemy_tiles().tolist():
+            self.add_enemy(Enemy((x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE)))
+        self._static_lights = dict()
+        self._static_light_cells = dict()
+        self._static_light_radius = 0
+        self._dynamic_lights = dict()
+        self._dirty_static_lights = dict()
+        self._light_expiry = dict()
+        self._light_requests = dict()
+        self._light_patches = dict()
+        self._walls_generation = 0
+        self._shadow_casters = dict()
+        bullet_light = get_light_falloff(BULLET_LIGHT_RADIUS) * BULLET_LIGHT_INTENSITY
+        self._bullet_light_offsets = np.argwhere(bullet_light > 0) - BULLET_LIGHT_RADIUS
+        self._bullet_light_weights = bullet_light[bullet_light > 0]
+        for x, y in map_data.get_torch_tiles().tolist():
+            self.add_light_source(LightSource((x * WORLD_TILE_SIZE, y * WORLD_TILE_SIZE), TORCH_LIGHT_RADIUS,
+                                              TORCH_LIGHT_INTENSITY, static=True))
+        self._flow_field = FlowField(self._tile_types, FLOW_FIELD_MAX_DISTANCE)
+        self._line_of_sight = LineOfSight(self._tile_types, map_data.get_wall_bitmap())
+        self._tile_collider = TileCollider(self._tile_types)
+        self._bullets = BulletSystem(self._tile_collider)
 
     def _is_correct_chunk_coords(self, x, y):
-        return not (y >= len(self._tile_chunks[x]) or y < 0 or x >= len(self._tile_chunks) or x < 0)
+        return not (x >= len(self._tile_chunks) or x < 0 or y >= len(self._tile_chunks[x]) or y < 0)
 
     def _is_correct_tile_coords(self, x, y):
         return not (x < 0 or x >= self._size[0] or y < 0 or y >= self._size[1])
 
-    def _get_chunks_around_pos(self, pos_tiles):
-        ccp = (int(pos_tiles[0] // self._chunk_size_tiles[0]),
-               int(pos_tiles[1] // self._chunk_size_tiles[1]))
-        return [self._tile_chunks[x][y] for x, y in product(range(ccp[0] - 1, ccp[0] + 2),
-                                                            range(ccp[1] - 1, ccp[1] + 2))
-                if self._is_correct_chunk_coords(x, y)]
+    def _get_visible_chunks(self, camera):
+        offset = tuple(map(int, camera.get_canvas_offset()))
+        chunk_w, chunk_h = self._chunk_size_tiles[0] * WORLD_TILE_SIZE, self._chunk_size_tiles[1] * WORLD_TILE_SIZE
+        chunks_x = range(offset[0] // chunk_w, (offset[0] + DISPLAY_SIZE[0] - 1) // chunk_w + 1)
+        chunks_y = range(offset[1] // chunk_h, (offset[1] + DISPLAY_SIZE[1] - 1) // chunk_h + 1)
+        return [(x, y) for x, y in product(chunks_x, chunks_y) if self._is_correct_chunk_coords(x, y)]
+
+    def _render_chunk(self, x, y):
+        x0, y0, x1, y1 = self._tile_chunks[x][y]
+        chunk_surface = pygame.Surface(((x1 - x0) * WORLD_TILE_SIZE, (y1 - y0) * WORLD_TILE_SIZE))
+        if pygame.display.get_surface() is not None:
+            chunk_surface = chunk_surface.convert()
+        tile_types = self._tile_types[x0:x1, y0:y1].tolist()
+        chunk_surface.blits([(self._tile_textures[tile_types[tx][ty]], (tx * WORLD_TILE_SIZE, ty * WORLD_TILE_SIZE))
+                             for tx, ty in product(range(x1 - x0), range(y1 - y0))], doreturn=False)
+        return chunk_surface
+
+    def _get_chunk_surface(self, x, y):
+        chunk_surface = self._chunk_surfaces.get((x, y))
+        if chunk_surface is None:
+            chunk_surface = self._chunk_surfaces[(x, y)] = self._render_chunk(x, y)
+            while len(self._chunk_surfaces) > CHUNK_CACHE_SIZE:
+                self._chunk_surfaces.popitem(last=False)
+        else:
+            self._chunk_surfaces.move_to_end((x, y))
+        return chunk_surface
+
+    def _stream_chunks(self, visible_chunks):
+        xs, ys = [chunk[0] for chunk in visible_chunks], [chunk[1] for chunk in visible_chunks]
+        for x, y in product(range(min(xs) - CHUNK_PREFETCH_MARGIN, max(xs) + CHUNK_PREFETCH_MARGIN + 1),
+                            range(min(ys) - CHUNK_PREFETCH_MARGIN, max(ys) + CHUNK_PREFETCH_MARGIN + 1)):
+            if self._is_correct_chunk_coords(x, y) and (x, y) not in self._chunk_surfaces:
+                self._get_chunk_surface(x, y)
+                return
 
     def check_collisions_and_fix_move_vector(self, entity, entity_move):
-        result_move = [0, 0]
-        start_pos = entity.get_position()
-        start_pos_tiles = int(start_pos[0] // WORLD_TILE_SIZE), int(start_pos[1] // WORLD_TILE_SIZE)
-        entity.move((entity_move[0], 0))
-        for x, y in product(range(start_pos_tiles[0] - 1, start_pos_tiles[0] + 2),
-                            range(start_pos_tiles[1] - 1, start_pos_tiles[1] + 2)):
-            if self._is_correct_tile_coords(x, y) and self._tiles[x][y].get_type() == 1:
-                if pygame.sprite.collide_rect(entity.get_sprite(), self._tiles[x][y].get_sprite()):
-                    break
-        else:
-            result_move[0] = entity_move[0]
-        entity.move((0, entity_move[1]))
-        for x, y in product(range(start_pos_tiles[0] - 1, start_pos_tiles[0] + 2),
-                            range(start_pos_tiles[1] - 1, start_pos_tiles[1] + 2)):
-            if self._is_correct_tile_coords(x, y) and self._tiles[x][y].get_type() == 1:
-                if pygame.sprite.collide_rect(entity.get_sprite(), self._tiles[x][y].get_sprite()):
-                    break
+        return self._tile_collider.resolve(entity.get_position(), entity.get_size(), entity_move)
+
+    def add_light_source(self, source, lifetime=None):
+        if source.is_static():
+            tile = self._get_light_tile(source)
+            cell = self._static_lights[source] = (tile[0] // self._chunk_size_tiles[0],
+                                                  tile[1] // self._chunk_size_tiles[1])
+            self._static_light_cells.setdefault(cell, dict())[source] = None
+            self._static_light_radius = max(self._static_light_radius, source.get_radius())
+            self._dirty_static_lights[source] = None
         else:
-            result_move[1] = entity_move[1]
-        entity.set_position(start_pos)
-        return tuple(result_move)
-
-    def add_light_source(self, source):
-        self._light_sources.append(source)
-
-    def _get_tiles_between(self, pos1, pos2):
-        dx, dy = int(pos1[0]) - int(pos2[0]), int(pos1[1]) - int(pos2[1])
-        L = max(abs(dx), abs(dy))
-        if not L:
-            return list()
-        dx, dy = dx / L, dy / L
+            self._dynamic_lights[source] = None
+        if lifetime is not None:
+            self._light_expiry[source] = time_line.get_time() + lifetime
+
+    def remove_light_source(self, source):
+        cell = self._static_lights.pop(source, None)
+        if cell is not None:
+            del self._static_light_cells[cell][source]
+            if not self._static_light_cells[cell]:
+                del self._static_light_cells[cell]
+        self._dynamic_lights.pop(source, None)
+        self._dirty_static_lights.pop(source, None)
+        self._light_expiry.pop(source, None)
+        self._light_requests.pop(source, None)
+        applied = self._light_patches.pop(source, None)
+        if applied is not None and source.is_static():
+            add_light_patch(self._static_light, *applied, scale=-1.0)
+
+    def add_muzzle_flash(self, position):
+        self.add_light_source(LightSource(position, MUZZLE_FLASH_RADIUS, MUZZLE_FLASH_INTENSITY), MUZZLE_FLASH_DURATION)
+
+    def get_light_count(self):
+        return len(self._static_lights) + len(self._dynamic_lights)
+
+    def _get_shadow_caster(self, radius):
+        shadow_caster = self._shadow_casters.get(radius)
+        if shadow_caster is None:
+            shadow_caster = self._shadow_casters[radius] = ShadowCaster(self._tile_types, radius)
+        return shadow_caster
+
+    def _get_light_tile(self, source):
+        position = source.get_new_position()
+        return int(position[0] // WORLD_TILE_SIZE), int(position[1] // WORLD_TILE_SIZE)
+
+    def _is_light_in_range(self, source, x0, y0, x1, y1):
+        x, y = self._get_light_tile(source)
+        radius = source.get_radius()
+        return x + radius >= x0 and x - radius < x1 and y + radius >= y0 and y - radius < y1
+
+    def _query_static_lights(self, x0, y0, x1, y1):
         result = list()
-        x, y = pos2
-        for i in range(L):
-            if self._is_correct_tile_coords(x, y):
-                result.append(self._tiles[round(x)][round(y)])
-            x, y = x + dx, y + dy
+        radius = self._static_light_radius
+        chunk_w, chunk_h = self._chunk_size_tiles
+        for cell in product(range((x0 - radius) // chunk_w, (x1 + radius - 1) // chunk_w + 1),
+                            range((y0 - radius) // chunk_h, (y1 + radius - 1) // chunk_h + 1)):
+            bucket = self._static_light_cells.get(cell)
+            if bucket:
+                result.extend(source for source in bucket if self._is_light_in_range(source, x0, y0, x1, y1))
         return result
 
-    def _find_path_between(self, pos1, pos2):
-        pos1, pos2 = tuple(map(int, pos1)), tuple(map(int, pos2))
-        tile_tags = [[-1] * self._size[1] for _ in range(self._size[0])]
-        tile_tags[pos1[0]][pos1[1]] = 0
-        vs = {pos1}
-        while vs and tile_tags[pos2[0]][pos2[1]] == -1:
-            pos = vs.pop()
-            if (self._is_correct_tile_coords(pos[0], pos[1] + 1) and tile_tags[pos[0]][pos[1] + 1] == -1 and
-                    self._tiles[pos[0]][pos[1] + 1].get_type() == 0):
-                tile_tags[pos[0]][pos[1] + 1] = tile_tags[pos[0]][pos[1]] + 1
-                vs.add((pos[0], pos[1] + 1))
-            if (self._is_correct_tile_coords(pos[0], pos[1] - 1) and tile_tags[pos[0]][pos[1] - 1] == -1 and
-                    self._tiles[pos[0]][pos[1] - 1].get_type() == 0):
-                tile_tags[pos[0]][pos[1] - 1] = tile_tags[pos[0]][pos[1]] + 1
-                vs.add((pos[0], pos[1] - 1))
-            if (self._is_correct_tile_coords(pos[0] + 1, pos[1]) and tile_tags[pos[0] + 1][pos[1]] == -1 and
-                    self._tiles[pos[0] + 1][pos[1]].get_type() == 0):
-                tile_tags[pos[0] + 1][pos[1]] = tile_tags[pos[0]][pos[1]] + 1
-                vs.add((pos[0] + 1, pos[1]))
-            if (self._is_correct_tile_coords(pos[0] - 1, pos[1]) and tile_tags[pos[0] - 1][pos[1]] == -1 and
-                    self._tiles[pos[0] - 1][pos[1]].get_type() == 0):
-                tile_tags[pos[0] - 1][pos[1]] = tile_tags[pos[0]][pos[1]] + 1
-                vs.add((pos[0] - 1, pos[1]))
-
-        path = [pos2]
-        while path[-1] != pos1:
-            if (self._is_correct_tile_coords(path[-1][0], path[-1][1] + 1) and
-                    tile_tags[path[-1][0]][path[-1][1] + 1] + 1 == tile_tags[path[-1][0]][path[-1][1]]):
-                path.append((path[-1][0], path[-1][1] + 1))
-            elif (self._is_correct_tile_coords(path[-1][0], path[-1][1] - 1) and
-                  tile_tags[path[-1][0]][path[-1][1] - 1] + 1 == tile_tags[path[-1][0]][path[-1][1]]):
-                path.append((path[-1][0], path[-1][1] - 1))
-            elif (self._is_correct_tile_coords(path[-1][0] + 1, path[-1][1]) and
-                  tile_tags[path[-1][0] + 1][path[-1][1]] + 1 == tile_tags[path[-1][0]][path[-1][1]]):
-                path.append((path[-1][0] + 1, path[-1][1]))
-            elif (self._is_correct_tile_coords(path[-1][1] - 1, path[-1][1]) and
-                  tile_tags[path[-1][0] - 1][path[-1][1]] + 1 == tile_tags[path[-1][0]][path[-1][1]]):
-                path.append((path[-1][0] - 1, path[-1][1]))
-        return path[::-1]
+    def update_light_sources(self, view=None):
+        now = time_line.get_time()
+        for source in [source for source, expiry in self._light_expiry.items() if expiry <= now]:
+            self.remove_light_source(source)
+        if view is None:
+            static_lights = list(self._dirty_static_lights)
+        else:
+            margin_x = CHUNK_PREFETCH_MARGIN * self._chunk_size_tiles[0]
+            margin_y = CHUNK_PREFETCH_MARGIN * self._chunk_size_tiles[1]
+            static_lights = [source for source in self._query_static_lights(view[0] - margin_x, view[1] - margin_y,
+                                                                            view[2] + margin_x, view[3] + margin_y)
+                             if source in self._dirty_static_lights]
+            static_lights.sort(key=lambda source: not self._is_light_in_range(source, *view))
+        bakes_left = STATIC_LIGHT_BAKE_LIMIT if view is not None else len(static_lights)
+        for source in static_lights:
+            if not bakes_left:
+                break
+            if self._calculate_light_from_source(source):
+                del self._dirty_static_lights[source]
+                bakes_left -= 1
+        for source in self._dynamic_lights:
+            if view is None or self._is_light_in_range(source, *view):
+                self._calculate_light_from_source(source)
+            else:
+                self._light_requests.pop(source, None)
+                self._light_patches.pop(source, None)
 
     def _calculate_light_from_source(self, source):
-        op = source.get_old_position()
-        owp = int(op[0] // WORLD_TILE_SIZE), int(op[1] // WORLD_TILE_SIZE)
-        np = source.get_new_position()
-        nwp = int(np[0] // WORLD_TILE_SIZE), int(np[1] // WORLD_TILE_SIZE)
-        # if nwp == owp:
-        #     return
-        for x, y in product(range(owp[0] - LIGHT_SOURCE_RADIUS, owp[0] + LIGHT_SOURCE_RADIUS + 1),
-                            range(owp[1] - LIGHT_SOURCE_RADIUS, owp[1] + LIGHT_SOURCE_RADIUS + 1)):
-            if not self._is_correct_tile_coords(x, y):
-                continue
-            self._tiles[x][y].set_darkness(1.0)
-        for x, y in product(range(nwp[0] - LIGHT_SOURCE_RADIUS, nwp[0] + LIGHT_SOURCE_RADIUS + 1),
-                            range(nwp[1] - LIGHT_SOURCE_RADIUS, nwp[1] + LIGHT_SOURCE_RADIUS + 1)):
-            if not self._is_correct_tile_coords(x, y):
-                continue
-            if any(map(lambda z: z.get_type(), self._get_tiles_between((x, y), nwp))):
-                continue
-            dist = ((x - nwp[0]) ** 2 + (y - nwp[1]) ** 2) ** 0.5
-            lightness = max(0.0, min(2 / (dist + 0.001) - 2 / LIGHT_SOURCE_RADIUS, 1.0))
-            self._tiles[x][y].set_darkness(1 - lightness)
+        tile = self._get_light_tile(source)
+        radius = source.get_radius()
+        if not source.is_static():
+            radius = min(radius, quality_governor.get('light_radius'))
+        if (tile, radius) == self._light_requests.get(source) and not source.is_dirty():
+            return True
+        if job_system.is_pending(source):
+            return False
+        self._light_requests[source] = (tile, radius)
+        shadow_caster = self._get_shadow_caster(radius)
+        job_system.submit(source, partial(self._apply_light, source, tile, radius, self._walls_generation),
+                          compute_light_patch, shadow_caster.get_walls(tile), shadow_caster.get_radius(),
+                          shadow_caster.get_falloff())
         source.update()
+        return True
+
+    def _apply_light(self, source, tile, radius, generation, patch):
+        if self._light_requests.get(source) != (tile, radius):
+            return
+        if generation != self._walls_generation:
+            del self._light_requests[source]
+            if source.is_static():
+                self._dirty_static_lights[source] = None
+            return
+        patch = patch * source.get_intensity()
+        if source.is_static():
+            if source in self._light_patches:
+                add_light_patch(self._static_light, *self._light_patches[source], scale=-1.0)
+            add_light_patch(self._static_light, tile, patch)
+        self._light_patches[source] = (tile, patch)
+
+    def _compose_light(self, x0, y0, x1, y1):
+        light = self._static_light[x0:x1, y0:y1].copy()
+        for source in self._dynamic_lights:
+            applied = self._light_patches.get(source)
+            if applied is not None:
+                tile, patch = applied
+                add_light_patch(light, (tile[0] - x0, tile[1] - y0), patch)
+        bullet_tiles = self._bullets.get_tiles()
+        if len(bullet_tiles) and quality_governor.get('bullet_lights'):
+            lit = (bullet_tiles[:, None, :] + self._bullet_light_offsets[None, :, :] - (x0, y0)).reshape(-1, 2)
+            weights = np.broadcast_to(self._bullet_light_weights, (len(bullet_tiles), len(self._bullet_light_weights)))
+            inside = (lit >= 0).all(axis=1) & (lit < light.shape).all(axis=1)
+            np.add.at(light, tuple(lit[inside].T), weights.reshape(-1)[inside])
+        darkness = 1.0 - np.clip(light, 0.0, 1.0)
+        view_darkness = self._darkness[x0:x1, y0:y1]
+        changed = darkness != view_darkness
+        if changed.any():
+            xs, ys = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            self._dirty_light_windows.append((x0 + int(xs[0]), y0 + int(ys[0]),
+                                              x0 + int(xs[-1]) + 1, y0 + int(ys[-1]) + 1))
+            view_darkness[...] = darkness
+
+    def sync_jobs(self):
+        job_system.sync()
+
+    def invalidate_frame(self):
+        self._last_draw_offset = None
+
+    def set_tile(self, x, y, tile_type):
+        if self._tile_types[x, y] == tile_type:
+            return
+        self._tile_types[x, y] = tile_type
+        self._walls_generation += 1
+        self._chunk_surfaces.pop((x // self._chunk_size_tiles[0], y // self._chunk_size_tiles[1]), None)
+        self._last_draw_offset = None
+        self._flow_field.invalidate()
+        self._line_of_sight.invalidate()
+        for source in chain(self._query_static_lights(x, y, x + 1, y + 1), self._dynamic_lights):
+            tile = self._get_light_tile(source)
+            if max(abs(tile[0] - x), abs(tile[1] - y)) <= source.get_radius():
+                source.mark_dirty()
+                if source.is_static():
+                    self._dirty_static_lights[source] = None
 
     def add_entity(self, entity):
-        self._entity_sprite_group.add(entity.get_sprite())
+        if entity.get_spatial_hash() is None:
+            self._unindexed_entities[entity] = None
+        return self._entities.create(entity)
 
     def remove_entity(self, entity):
-        self._entity_sprite_group.remove(entity.get_sprite())
+        self._unindexed_entities.pop(entity, None)
+        self._entities.destroy(entity.get_id())
+
+    def flush_removed_entities(self):
+        removed = self._entities.flush()
+        for entity in removed:
+            entity.release_texture()
+        if removed:
+            texture_manager.evict_unused()
+
+    def get_entity(self, entity_id):
+        return self._entities.get(entity_id)
 
     def add_enemy(self, enemy):
-        self._enemies.append(enemy)
-        self.add_entity(enemy)
+        self._enemy_index.insert(enemy)
+        return self.add_entity(enemy)
 
     def remove_enemy(self, enemy):
-        self._enemies.remove(enemy)
+        self._enemy_index.remove(enemy)
         self.remove_entity(enemy)
 
     def update_enemies(self, dt, player):
-        for enemy in self._enemies:
-
-            if enemy.get_health() <= 0:
-                self.remove_enemy(enemy)
-                continue
-
-            if pygame.sprite.collide_rect(enemy.get_sprite(), player.get_sprite()):
-                if enemy.can_attack():
-                    player.hit(1)
-                    enemy.attack()
-
+        for enemy in self._enemy_index.query_rect(player.get_sprite().rect):
+            if enemy.can_attack():
+                player.hit(1)
+                enemy.attack()
+
+        self._ai_scheduler.set_limits(quality_governor.get('ai_budget'), quality_governor.get('ai_near_interval'))
+        self._ai_scheduler.begin_tick()
+        player_world_pos = tuple(map(lambda x: x / WORLD_TILE_SIZE, player.get_position()))
+        player_tile = int(player_world_pos[0]), int(player_world_pos[1])
+        scheduled = list()
+        observation_radius = ENEMY_OBSERVATION_RADIUS * WORLD_TILE_SIZE
+        for enemy in self._enemy_index.query_radius(player.get_position(), observation_radius):
             enemy_world_pos = tuple(map(lambda x: x / WORLD_TILE_SIZE, enemy.get_position()))
-            player_world_pos = tuple(map(lambda x: x / WORLD_TILE_SIZE, player.get_position()))
             dist = ((enemy_world_pos[0] - player_world_pos[0]) ** 2 +
                     (enemy_world_pos[1] - player_world_pos[1]) ** 2) ** 0.5
-            if dist >= ENEMY_OBSERVATION_RADIUS or dist < 0.7:
+            if dist >= ENEMY_OBSERVATION_RADIUS:
                 continue
-            if any(map(lambda x: x.get_type(), self._get_tiles_between(enemy_world_pos, player_world_pos))):
-                path = self._find_path_between(enemy_world_pos, player_world_pos)
-                to_player = (path[1][0] - path[0][0], path[1][1] - path[0][1])
-                dist = (to_player[0] ** 2 + to_player[1] ** 2) ** 0.5
-                # print('OBS')
+            active = dist < ENEMY_ACTIVE_RADIUS
+            if self._ai_scheduler.is_due(enemy.get_id(), active):
+                scheduled.append((not active, enemy.get_decision_tick(), enemy.get_id(), enemy, enemy_world_pos, dist))
+        profiler.set_counter('ai_scheduled', len(scheduled))
+
+        for inactive, decision_tick, _, enemy, enemy_world_pos, dist in sorted(scheduled, key=lambda item: item[:3]):
+            if self._ai_scheduler.take_budget():
+                direction = self._decide_enemy_direction(enemy_world_pos, player_world_pos, player_tile, dist)
+                enemy.set_decision(direction, self._ai_scheduler.get_tick())
+                profiler.count('ai_decisions')
             else:
-                to_player = (player_world_pos[0] - enemy_world_pos[0], player_world_pos[1] - enemy_world_pos[1])
-                # print('NO OBS')
-            to_player = (to_player[0] / dist * dt / 1000 * PLAYER_SPEED * 0.5,
-                         to_player[1] / dist * dt / 1000 * PLAYER_SPEED * 0.5)
-            # print(to_player)
-            to_player = self.check_collisions_and_fix_move_vector(enemy, to_player)
+                direction = enemy.get_direction()
+                profiler.count('ai_deferred')
+            if direction is None:
+                continue
+            step = dt * self._ai_scheduler.get_interval(not inactive) / 1000 * PLAYER_SPEED * 0.5
+            to_player = self.check_collisions_and_fix_move_vector(enemy, (direction[0] * step, direction[1] * step))
             enemy.move(to_player)
 
+    def _decide_enemy_direction(self, enemy_world_pos, player_world_pos, player_tile, dist):
+        if dist < 0.7:
+            return None
+        enemy_tile = int(enemy_world_pos[0]), int(enemy_world_pos[1])
+        profiler.count('los_queries')
+        if self._line_of_sight.is_clear(enemy_tile, player_tile):
+            return ((player_world_pos[0] - enemy_world_pos[0]) / dist,
+                    (player_world_pos[1] - enemy_world_pos[1]) / dist)
+        with profiler.span('pathfinding'):
+            if self._flow_field.update(player_tile):
+                profiler.count('paths_computed')
+        next_tile = self._flow_field.get_next_step(enemy_tile)
+        if next_tile is None:
+            return None
+        return next_tile[0] - enemy_tile[0], next_tile[1] - enemy_tile[1]
+
     def update_bullets(self, dt):
-        for bullet in self._bullets:
-            bv = bullet.get_velocity()
-            move_vector = (bv[0] * dt / 1000, bv[1] * dt / 1000)
-            mv1 = self.check_collisions_and_fix_move_vector(bullet, move_vector)
-            if mv1 != move_vector:
-                self.remove_bullet(bullet)
-                continue
-            bullet.move(move_vector)
-            for enemy in self._enemies:
-                if pygame.sprite.collide_rect(bullet.get_sprite(), enemy.get_sprite()):
-                    enemy.hit(1)
-                    self.remove_bullet(bullet)
-
-    def draw(self, camera, surface):
-        camera_pos = camera.get_position()
-        chunks_around_camera = self._get_chunks_around_pos((camera_pos[0] // WORLD_TILE_SIZE,
-                                                            camera_pos[1] // WORLD_TILE_SIZE))
-        draw_group = pygame.sprite.Group()
-        light_draw_list = list()
-        for chunk in chunks_around_camera:
-            for tile in chunk:
-                if tile.get_sprite().rect.colliderect(pygame.Rect((*camera.get_canvas_offset(), *DISPLAY_SIZE))):
-                    draw_group.add(tile.get_sprite())
-                    light_draw_list.append(tile)
-        draw_group.draw(surface)
-        self._entity_sprite_group.draw(surface)
-
-        for source in self._light_sources:
-            self._calculate_light_from_source(source)
-
-        for tile in light_draw_list:
-            tile.draw_light_mask(surface)
-
-    def add_bullet(self, bullet):
-        self._bullets.append(bullet)
-        self.add_entity(bullet)
-
-    def remove_bullet(self, bullet):
-        if bullet in self._bullets:
-            self._bullets.remove(bullet)
-            self.remove_entity(bullet)
+        for enemy in self._bullets.update(dt, self._enemy_index):
+            enemy.hit(1)
+            if enemy.is_dead() and enemy in self._enemy_index:
+                self.remove_enemy(enemy)
+
+    def _get_visible_tiles_range(self, camera):
+        offset = tuple(map(int, camera.get_canvas_offset()))
+        return (max(offset[0] // WORLD_TILE_SIZE, 0),
+                max(offset[1] // WORLD_TILE_SIZE, 0),
+                min((offset[0] + DISPLAY_SIZE[0] - 1) // WORLD_TILE_SIZE + 1, self._size[0]),
+                min((offset[1] + DISPLAY_SIZE[1] - 1) // WORLD_TILE_SIZE + 1, self._size[1]))
+
+    def _build_light_mask(self, x0, y0, x1, y1):
+        if self._light_mask is None or self._light_mask.get_size() != (x1 - x0, y1 - y0):
+            self._light_mask = pygame.Surface((x1 - x0, y1 - y0), pygame.SRCALPHA)
+            self._light_mask.fill((0, 0, 0, 255))
+        alpha = pygame.surfarray.pixels_alpha(self._light_mask)
+        np.rint(self._darkness[x0:x1, y0:y1] * 255, out=alpha, casting='unsafe')
+        del alpha
+        mask_size = ((x1 - x0) * WORLD_TILE_SIZE, (y1 - y0) * WORLD_TILE_SIZE)
+        if quality_governor.get('light_mask_smooth'):
+            return pygame.transform.smoothscale(self._light_mask, mask_size)
+        return pygame.transform.scale(self._light_mask, mask_size)
+
+    def save_positions(self):
+        self._bullets.save_positions()
+
+    def _get_entity_blits(self, alpha, offset):
+        blit_list = list()
+        view = pygame.Rect(offset, DISPLAY_SIZE)
+        candidates_view = view.inflate(2 * WORLD_TILE_SIZE, 2 * WORLD_TILE_SIZE)
+        candidates = chain(sorted(self._key_index.query_rect(candidates_view), key=Entity.get_id),
+                           sorted(self._enemy_index.query_rect(candidates_view), key=Entity.get_id),
+                           self._unindexed_entities)
+        for entity in candidates:
+            image = entity.get_sprite().image
+            x, y = entity.get_interpolated_position(alpha)
+            corner = (round(x) - image.get_width() // 2, round(y) - image.get_height() // 2)
+            if view.colliderect((corner, image.get_size())):
+                blit_list.append((image, (corner[0] - offset[0], corner[1] - offset[1])))
+        blit_list.extend(self._bullets.get_blits(alpha, offset))
+        return blit_list
+
+    def _get_dirty_rects(self, surface, offset, entity_rects):
+        if offset != self._last_draw_offset or quality_governor.get_level() != self._last_quality_level:
+            return [surface.get_rect()]
+        margin = WORLD_TILE_SIZE if quality_governor.get('light_mask_smooth') else 0
+        dirty_rects = [pygame.Rect(rect) for rect in entity_rects.symmetric_difference(self._last_entity_rects)]
+        for x0, y0, x1, y1 in self._dirty_light_windows:
+            dirty_rects.append(pygame.Rect(x0 * WORLD_TILE_SIZE - offset[0] - margin,
+                                           y0 * WORLD_TILE_SIZE - offset[1] - margin,
+                                           (x1 - x0) * WORLD_TILE_SIZE + 2 * margin,
+                                           (y1 - y0) * WORLD_TILE_SIZE + 2 * margin))
+        dirty_rects = [rect.clip(surface.get_rect()) for rect in dirty_rects]
+        dirty_rects = [rect for rect in dirty_rects if rect.width and rect.height]
+        if len(dirty_rects) > DIRTY_RECT_LIMIT:
+            return [surface.get_rect()]
+        return dirty_rects
+
+    def draw(self, camera, surface, alpha=1.0, dirty_only=False):
+        offset = tuple(map(int, camera.get_canvas_offset()))
+        visible_tiles = self._get_visible_tiles_range(camera)
+        self._light_mask_age += 1
+        refresh_light = (visible_tiles != self._light_view or
+                         self._light_mask_age >= quality_governor.get('light_mask_interval'))
+        if refresh_light:
+            with profiler.span('lighting'):
+                self.update_light_sources(visible_tiles)
+                self._compose_light(*visible_tiles)
+
+        entity_blits = self._get_entity_blits(alpha, offset)
+        entity_rects = {(*position, *image.get_size()) for image, position in entity_blits}
+        if dirty_only:
+            dirty_rects = self._get_dirty_rects(surface, offset, entity_rects)
+        else:
+            dirty_rects = [surface.get_rect()]
+        self._last_draw_offset = offset
+        self._last_quality_level = quality_governor.get_level()
+        self._last_entity_rects = entity_rects
+        self._dirty_light_windows.clear()
+        if not dirty_rects:
+            return dirty_rects
+
+        with profiler.span('terrain'):
+            visible_chunks = self._get_visible_chunks(camera)
+            chunk_blits = list()
+            for x, y in visible_chunks:
+                chunk_x0, chunk_y0 = self._tile_chunks[x][y][:2]
+                chunk_blits.append((self._get_chunk_surface(x, y), (chunk_x0 * WORLD_TILE_SIZE - offset[0],
+                                                                    chunk_y0 * WORLD_TILE_SIZE - offset[1])))
+            if visible_chunks:
+                self._stream_chunks(visible_chunks)
+        with profiler.span('light_mask'):
+            x0, y0, x1, y1 = visible_tiles
+            if refresh_light or self._scaled_light_mask is None:
+                self._scaled_light_mask = self._build_light_mask(x0, y0, x1, y1)
+                self._light_view = visible_tiles
+                self._light_mask_age = 0
+            light_mask = self._scaled_light_mask
+            light_mask_position = (x0 * WORLD_TILE_SIZE - offset[0], y0 * WORLD_TILE_SIZE - offset[1])
+
+        for dirty_rect in dirty_rects:
+            surface.set_clip(dirty_rect)
+            with profiler.span('terrain'):
+                surface.blits(chunk_blits, doreturn=False)
+            with profiler.span('entities'):
+                if len(dirty_rects) == 1:
+                    surface.blits(entity_blits, doreturn=False)
+                else:
+                    surface.blits([entity_blits[i] for i in dirty_rect.collidelistall(
+                        [(position, image.get_size()) for image, position in entity_blits])], doreturn=False)
+            with profiler.span('light_mask'):
+                surface.blit(light_mask, light_mask_position)
+        surface.set_clip(None)
+        return dirty_rects
+
+    def add_bullet(self, position, velocity):
+        self._bullets.spawn(position, velocity)
+
+    def add_key(self, key):
+        self._key_index.insert(key)
+        return self.add_entity(key)
 
     def remove_key(self, key):
-        self._keys.remove(key)
+        self._key_index.remove(key)
         self.remove_entity(key)
 
     def get_keys(self):
-        return tuple(self._keys)
+        return tuple(self._entities.iterate(Key))
+
+    def get_enemies(self):
+        return self._entities.iterate(Enemy)
+
+    def get_key_count(self):
+        return len(self._key_index)
+
+    def get_entity_count(self):
+        return len(self._entities) + len(self._bullets)
+
+    def get_keys_in_rect(self, rect):
+        return self._key_index.query_rect(rect)
 
     def get_player_start_position(self):
         return self._player_start_position
@@ -477,13 +1845,133 @@ class GameWorld:
     def get_size(self):
         return self._size
 
-    def get_tile(self, x, y):
-        return self._tile[x][y]
+    def has_line_of_sight(self, tile1, tile2):
+        return self._line_of_sight.is_clear(tile1, tile2)
 
+    def get_tile(self, x, y):
+        return self._tile_types[x, y]
+
+    def get_tile_types(self):
+        return self._tile_types
+
+    def get_darkness(self):
+        return self._darkness
+
+
+RECORDING_FILE_MAGIC = b'YLRC'
+RECORDING_FILE_VERSION = 2
+RECORDING_FILE_HEADER = struct.Struct('<4sHH')
+RECORDING_FRAME = struct.Struct('<dBBBB')
+RECORDING_CLICK = struct.Struct('<Bhh')
+RECORDING_CHECKSUM = struct.Struct('<I')
+RECORDED_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d)
+
+
+class RecordedKeys:
+
+    def __init__(self, mask):
+        self._mask = mask
+
+    def __getitem__(self, key):
+        return key in RECORDED_KEYS and bool(self._mask >> RECORDED_KEYS.index(key) & 1)
+
+
+class InputRecording:
+
+    def __init__(self, map_name):
+        self._map_name = map_name
+        self._frames = list()
+
+    def add_frame(self, dt, events, keys_pressed, quality_level=0):
+        mask = sum(1 << i for i, key in enumerate(RECORDED_KEYS) if keys_pressed[key])
+        clicks = [(event.button, *event.pos) for event in events if event.type == pygame.MOUSEBUTTONDOWN]
+        self._frames.append((dt, mask, quality_level, clicks, list()))
+
+    def add_checksum(self, checksum):
+        self._frames[-1][4].append(checksum)
+
+    def get_map_name(self):
+        return self._map_name
+
+    def get_frames(self):
+        for dt, mask, quality_level, clicks, checksums in self._frames:
+            events = [pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=button, pos=(x, y)) for button, x, y in clicks]
+            yield dt, events, RecordedKeys(mask), quality_level, checksums
+
+    def get_frame_checksums(self, index):
+        return self._frames[index][4]
+
+    def get_tick_count(self):
+        return sum(len(frame[4]) for frame in self._frames)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def save(self, recording_path):
+        body = bytearray()
+        for dt, mask, quality_level, clicks, checksums in self._frames:
+            body += RECORDING_FRAME.pack(dt, mask, quality_level, len(clicks), len(checksums))
+            for click in clicks:
+                body += RECORDING_CLICK.pack(*click)
+            for checksum in checksums:
+                body += RECORDING_CHECKSUM.pack(checksum)
+        map_name = self._map_name.encode()
+        with open(recording_path, 'wb') as recording_file:
+            recording_file.write(RECORDING_FILE_HEADER.pack(RECORDING_FILE_MAGIC, RECORDING_FILE_VERSION,
+                                                            len(map_name)))
+            recording_file.write(map_name)
+            recording_file.write(zlib.compress(bytes(body)))
+
+    @staticmethod
+    def load(recording_path):
+        with open(recording_path, 'rb') as recording_file:
+            buffer = recording_file.read()
+        magic, version, name_length = RECORDING_FILE_HEADER.unpack_from(buffer)
+        if magic != RECORDING_FILE_MAGIC or version != RECORDING_FILE_VERSION:
+            raise ValueError(f'{recording_path} is not an input recording of version {RECORDING_FILE_VERSION}')
+        position = RECORDING_FILE_HEADER.size
+        recording = InputRecording(buffer[position:position + name_length].decode())
+        body = zlib.decompress(buffer[position + name_length:])
+        position = 0
+        while position < len(body):
+            dt, mask, quality_level, clicks_count, checksums_count = RECORDING_FRAME.unpack_from(body, position)
+            position += RECORDING_FRAME.size
+            clicks = [RECORDING_CLICK.unpack_from(body, position + i * RECORDING_CLICK.size)
+                      for i in range(clicks_count)]
+            position += clicks_count * RECORDING_CLICK.size
+            checksums = [RECORDING_CHECKSUM.unpack_from(body, position + i * RECORDING_CHECKSUM.size)[0]
+                         for i in range(checksums_count)]
+            position += checksums_count * RECORDING_CHECKSUM.size
+            recording._frames.append((dt, mask, quality_level, clicks, checksums))
+        return recording
+
+
+def get_state_checksum():
+    state = [*player.get_position(), player.get_health()]
+    for enemy in world.get_enemies():
+        state.extend(enemy.get_position())
+    return zlib.crc32(np.array(state, dtype=np.float64).tobytes())
+
+
+ATLAS_TEXTURES = (
+    ('tile' + str(TILE_FLOOR), (WORLD_TILE_SIZE, WORLD_TILE_SIZE), None),
+    ('tile' + str(TILE_WALL), (WORLD_TILE_SIZE, WORLD_TILE_SIZE), None),
+    ('player', None, (255, 255, 255)),
+    ('enemy', None, (255, 255, 255)),
+    ('key', None, (255, 255, 255)),
+    ('bullet', None, (255, 255, 255)),
+)
 
 screen = None
-fps_counter = None
+profiler = None
+job_system = None
+quality_governor = None
+input_recording = None
+simulation_clock = None
 time_line = None
+texture_manager = None
+text_cache = None
+hud = None
 
 world = None
 player = None
@@ -493,20 +1981,40 @@ canvas = None
 camera = None
 
 keys_to_find = None
+dirty_rects = None
+hud_rects = list()
 
 player_won = False
 player_lost = False
 
 
-def setup():
-    global screen, fps_counter, time_line, world, canvas, camera, player, keys_to_find
+def setup(headless=False, map_name=WORLD_MAP_NAME):
+    global screen, profiler, job_system, quality_governor, simulation_clock, time_line, texture_manager, text_cache, hud
+    global world, canvas, camera, player, keys_to_find, player_won, player_lost, input_recording
 
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
     pygame.init()
-    screen = pygame.display.set_mode(DISPLAY_SIZE)
-    fps_counter = FPSCounter()
+    if VSYNC:
+        screen = pygame.display.set_mode(DISPLAY_SIZE, pygame.SCALED, vsync=1)
+    else:
+        screen = pygame.display.set_mode(DISPLAY_SIZE)
+    profiler = FrameProfiler()
+    if job_system is not None:
+        job_system.shutdown()
+    job_system = JobSystem()
+    quality_governor = QualityGovernor()
+    simulation_clock = SimulationClock()
     time_line = TimeLine()
-
-    world = GameWorld(os.path.join('resources', WORLD_MAP_NAME), DISPLAY_SIZE)
+    texture_manager = TextureManager()
+    texture_manager.build_atlas(ATLAS_TEXTURES)
+    text_cache = TextCache()
+    hud = HUD()
+    hud.add_widget('health', HUDWidget('Здоровье: ', (255, 100, 100), (5, DISPLAY_SIZE[1] - 50)))
+    hud.add_widget('keys_to_find', HUDWidget('Ключей найти: ', (100, 255, 100), (5, DISPLAY_SIZE[1] - 25)))
+
+    world = GameWorld(get_compiled_map_path(os.path.join('resources', map_name)), DISPLAY_SIZE)
     player = Player(world.get_player_start_position())
     world.add_entity(player)
     world.add_light_source(player.get_light_source())
@@ -514,79 +2022,113 @@ def setup():
                     DISPLAY_SIZE,
                     player.get_position())
 
-    canvas = pygame.Surface((world.get_size()[0] * WORLD_TILE_SIZE, world.get_size()[1] * WORLD_TILE_SIZE))
-    keys_to_find = len(world.get_keys())
+    canvas = pygame.Surface(DISPLAY_SIZE)
+    keys_to_find = world.get_key_count()
+    player_won = player_lost = False
+    input_recording = None
 
 
 def draw_gui(surface):
-    font = pygame.font.Font(None, 18)
-    hp_text = font.render('Здоровье: ' + str(player.get_health()), 1, (255, 100, 100))
-    key_to_find_text = font.render('Ключей найти: ' + str(keys_to_find), 1, (100, 255, 100))
-    surface.blit(hp_text, (5, DISPLAY_SIZE[1] - 50))
-    surface.blit(key_to_find_text, (5, DISPLAY_SIZE[1] - 25))
+    hud.set_value('health', player.get_health())
+    hud.set_value('keys_to_find', keys_to_find)
+    return [hud.draw(surface)]
 
 
-def loop(dt, events):
+def update(dt, keys_pressed):
     global keys_to_find, player_won, player_lost
 
-    for event in events:
-        if event.type == pygame.QUIT:
-            return False
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            mouse_pos = pygame.mouse.get_pos()
-            canvas_offset = camera.get_canvas_offset()
-            mouse_game_pos = (mouse_pos[0] + canvas_offset[0], mouse_pos[1] + canvas_offset[1])
-            bullet = player.attack(mouse_game_pos)
-            if bullet is not None:
-                world.add_bullet(bullet)
-
-    if not (player_lost or player_won):
-
-        time_line.update(dt)
+    time_line.update(dt)
+    world.save_positions()
 
+    with profiler.span('enemy_ai'):
         world.update_enemies(dt, player)
+    with profiler.span('bullets'):
         world.update_bullets(dt)
 
-        keys_pressed = pygame.key.get_pressed()
-        if keys_pressed[pygame.K_w]:
-            move_vector = world.check_collisions_and_fix_move_vector(player, (0, -PLAYER_SPEED * dt / 1000))
-            player.move(move_vector)
-        elif keys_pressed[pygame.K_s]:
-            move_vector = world.check_collisions_and_fix_move_vector(player, (0, PLAYER_SPEED * dt / 1000))
-            player.move(move_vector)
-        if keys_pressed[pygame.K_d]:
-            move_vector = world.check_collisions_and_fix_move_vector(player, (PLAYER_SPEED * dt / 1000, 0))
-            player.move(move_vector)
-        elif keys_pressed[pygame.K_a]:
-            move_vector = world.check_collisions_and_fix_move_vector(player, (-PLAYER_SPEED * dt / 1000, 0))
-            player.move(move_vector)
-
-        keys = world.get_keys()
-        for key in keys:
-            if pygame.sprite.collide_rect(player.get_sprite(), key.get_sprite()):
-                world.remove_key(key)
-                keys_to_find -= 1
-
-        if player.get_health() <= 0:
-            player_lost = True
+    if keys_pressed[pygame.K_w]:
+        move_vector = world.check_collisions_and_fix_move_vector(player, (0, -PLAYER_SPEED * dt / 1000))
+        player.move(move_vector)
+    elif keys_pressed[pygame.K_s]:
+        move_vector = world.check_collisions_and_fix_move_vector(player, (0, PLAYER_SPEED * dt / 1000))
+        player.move(move_vector)
+    if keys_pressed[pygame.K_d]:
+        move_vector = world.check_collisions_and_fix_move_vector(player, (PLAYER_SPEED * dt / 1000, 0))
+        player.move(move_vector)
+    elif keys_pressed[pygame.K_a]:
+        move_vector = world.check_collisions_and_fix_move_vector(player, (-PLAYER_SPEED * dt / 1000, 0))
+        player.move(move_vector)
+
+    for key in world.get_keys_in_rect(player.get_sprite().rect):
+        world.remove_key(key)
+        keys_to_find -= 1
+
+    world.flush_removed_entities()
+
+    if player.get_health() <= 0:
+        player_lost = True
+
+    if world.get_key_count() == 0:
+        player_won = True
+
+
+def loop(dt, events, keys_pressed=None):
+    global dirty_rects, hud_rects
+
+    dirty_rects = None
+    with profiler.span('input'):
+        for event in events:
+            if event.type == pygame.QUIT:
+                return False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.toggle_overlay()
+                world.invalidate_frame()
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                mouse_pos = event.pos
+                canvas_offset = camera.get_canvas_offset()
+                mouse_game_pos = (mouse_pos[0] + canvas_offset[0], mouse_pos[1] + canvas_offset[1])
+                shot = player.attack(mouse_game_pos)
+                if shot is not None:
+                    world.add_bullet(*shot)
+                    world.add_muzzle_flash(shot[0])
+        if keys_pressed is None:
+            keys_pressed = pygame.key.get_pressed()
+        if input_recording is not None:
+            input_recording.add_frame(dt, events, keys_pressed, quality_governor.get_level())
 
-        if len(world.get_keys()) == 0:
-            player_won = True
+    if not (player_lost or player_won):
 
-        camera.set_position(player.get_position())
-        world.draw(camera, canvas)
-        screen.blit(canvas, (0, 0), pygame.Rect((*camera.get_canvas_offset(), *DISPLAY_SIZE)))
-        draw_gui(screen)
+        with profiler.span('jobs'):
+            world.sync_jobs()
+        for _ in range(simulation_clock.advance(dt)):
+            update(simulation_clock.get_tick_time(), keys_pressed)
+            if input_recording is not None:
+                input_recording.add_checksum(get_state_checksum())
+            if player_lost or player_won:
+                break
+
+        alpha = simulation_clock.get_alpha()
+        camera.set_position(player.get_interpolated_position(alpha))
+        dirty_only = DIRTY_RECT_RENDERING and not profiler.is_overlay_shown()
+        world_rects = world.draw(camera, canvas, alpha, dirty_only)
+        with profiler.span('hud'):
+            old_hud_rects = hud_rects
+            for rect in world_rects + old_hud_rects:
+                screen.blit(canvas, rect, rect)
+            hud_rects = draw_gui(screen)
+            profiler.draw_overlay(screen)
+        if dirty_only:
+            dirty_rects = world_rects + old_hud_rects + hud_rects
+        profiler.set_counter('entity_count', world.get_entity_count())
+        profiler.set_counter('quality_level', quality_governor.get_level())
 
     else:
         screen.fill((0, 0, 0))
-        font = pygame.font.Font(None, 48)
         if player_lost:
-            text = font.render('Потрачено', 1, (200, 10, 10))
+            text = text_cache.render('Потрачено', (200, 10, 10), 48)
             place = text.get_rect(center=(DISPLAY_SIZE[0] // 2, DISPLAY_SIZE[1] // 2))
             screen.blit(text, place)
         else:
-            text = font.render('Победа!', 1, (100, 255, 100))
+            text = text_cache.render('Победа!', (100, 255, 100), 48)
             place = text.get_rect(center=(DISPLAY_SIZE[0] // 2, DISPLAY_SIZE[1] // 2))
             screen.blit(text, place)
 
@@ -594,22 +2136,85 @@ def loop(dt, events):
 
 
 def clear():
+    job_system.shutdown()
     pygame.quit()
 
 
-setup()
-
-clock = pygame.time.Clock()
-
-while True:
-
-    dt = clock.tick()
-    fps_counter.update(dt)
-    events = pygame.event.get()
+def replay(recording_path):
+    global input_recording
+
+    recording = InputRecording.load(recording_path)
+    setup(headless=True, map_name=recording.get_map_name())
+    input_recording = InputRecording(recording.get_map_name())
+    tick = 0
+    for dt, events, keys_pressed, quality_level, checksums in recording.get_frames():
+        quality_governor.set_level(quality_level)
+        loop(dt, events, keys_pressed)
+        profiler.end_frame()
+        for expected, actual in zip_longest(checksums, input_recording.get_frame_checksums(-1)):
+            if expected != actual:
+                return tick
+            tick += 1
+    return None
+
+
+def main():
+    global input_recording
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--profile', metavar='PATH', help='export frame metrics to a .json or .csv file on exit')
+    parser.add_argument('--compile-map', metavar='IMAGE', help='compile a map image into the binary format and exit')
+    parser.add_argument('--record', metavar='PATH', help='record input and state checksums to a file on exit')
+    parser.add_argument('--replay', metavar='PATH', help='replay a recording headless at full speed and verify it')
+    args = parser.parse_args()
+
+    if args.compile_map:
+        print(compile_map(args.compile_map))
+        return
+
+    if args.replay:
+        start = time.perf_counter()
+        mismatch = replay(args.replay)
+        elapsed = time.perf_counter() - start
+        print(f'{len(input_recording)} frames, {input_recording.get_tick_count()} ticks in {elapsed:.3f} s')
+        if args.profile:
+            profiler.export(args.profile)
+        clear()
+        if mismatch is not None:
+            print(f'state diverged at tick {mismatch}')
+            sys.exit(1)
+        return
+
+    setup(headless=args.headless)
+    if args.record:
+        input_recording = InputRecording(WORLD_MAP_NAME)
+
+    clock = pygame.time.Clock()
+
+    while True:
+
+        dt = clock.tick(FRAME_RATE_LIMIT)
+        events = pygame.event.get()
+
+        frame_start = time.perf_counter()
+        if not loop(dt, events):
+            break
+        quality_governor.add_frame_time((time.perf_counter() - frame_start) * 1000)
+
+        with profiler.span('flip'):
+            if dirty_rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty_rects)
+        profiler.end_frame()
 
-    if not loop(dt, events):
-        break
+    if args.profile:
+        profiler.export(args.profile)
+    if args.record:
+        input_recording.save(args.record)
+    clear()
 
-    pygame.display.flip()
 
-clear()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+MAP_COLOR_FLOOR = (0, 0, 0)
+MAP_COLOR_WALL = (255, 255, 255)
+MAP_COLOR_PLAYER = (0, 255, 0)
+MAP_COLOR_KEY = (0, 0, 255)
+MAP_COLOR_ENEMY = (255, 0, 0)
+MAP_COLOR_TORCH = (255, 255, 0)
+
+GENERATED_ROOM_AREA = 400  # tiles of map per room
+GENERATED_ROOM_SIZE = (6, 24)  # tiles, min and max side
+GENERATED_CORRIDOR_WIDTH = 2  # tiles
+GENERATED_WALL_DENSITY = 0.1  # share of open floor pillar spots turned into walls
+GENERATED_ENEMY_AREA = 800  # tiles of map per enemy
+GENERATED_KEY_AREA = 20000  # tiles of map per key
+GENERATED_TORCH_AREA = 1000  # tiles of map per torch
+GENERATED_SAFE_RADIUS = 8  # tiles around the player without enemies
+
+
+def place_rooms(rng, size, rooms, room_size):
+    sides = rng.integers(room_size[0], room_size[1] + 1, size=(rooms, 2))
+    sides = np.minimum(sides, np.array(size) - 2)
+    corners = rng.integers(1, np.array(size) - sides, size=(rooms, 2))
+    return np.concatenate((corners, corners + sides), axis=1)
+
+
+def order_rooms(rooms, band):
+    centers = (rooms[:, :2] + rooms[:, 2:]) // 2
+    bands = centers[:, 1] // band
+    return rooms[np.lexsort((np.where(bands % 2, -centers[:, 0], centers[:, 0]), bands))]
+
+
+def carve_corridor(walls, start, end, width):
+    (x0, y0), (x1, y1) = start, end
+    walls[min(x0, x1):max(x0, x1) + width, y0:y0 + width] = False
+    walls[x1:x1 + width, min(y0, y1):max(y0, y1) + width] = False
+
+
+def place_pillars(rng, walls, wall_density):
+    floor = ~walls
+    open_area = np.ones((walls.shape[0] - 2, walls.shape[1] - 2), dtype=bool)
+    for dx in range(3):
+        for dy in range(3):
+            open_area &= floor[dx:dx + open_area.shape[0], dy:dy + open_area.shape[1]]
+    lattice = open_area[::2, ::2]
+    walls[1:-1:2, 1:-1:2][:lattice.shape[0], :lattice.shape[1]] |= (
+        lattice & (rng.random(lattice.shape, dtype=np.float32) < wall_density))
+
+
+def generate_tiles(rng, size, rooms, room_size, corridor_width, wall_density):
+    walls = np.ones(size, dtype=bool)
+    rooms = order_rooms(place_rooms(rng, size, rooms, room_size), room_size[1] * 2)
+    for x0, y0, x1, y1 in rooms.tolist():
+        walls[x0:x1, y0:y1] = False
+    centers = ((rooms[:, :2] + rooms[:, 2:]) // 2).tolist()
+    for start, end in zip(centers, centers[1:]):
+        carve_corridor(walls, start, end, corridor_width)
+    walls[[0, -1], :] = True
+    walls[:, [0, -1]] = True
+    place_pillars(rng, walls, wall_density)
+    return walls, tuple(centers[0])
+
+
+def pick_tiles(rng, candidates, count):
+    return candidates[rng.choice(len(candidates), size=min(count, len(candidates)), replace=False)]
+
+
+def generate_map(size, rooms=None, room_size=GENERATED_ROOM_SIZE, corridor_width=GENERATED_CORRIDOR_WIDTH,
+                 wall_density=GENERATED_WALL_DENSITY, enemies=None, keys=None, torches=None, seed=0):
+    rng = np.random.default_rng(seed)
+    area = size[0] * size[1]
+    if rooms is None:
+        rooms = max(1, area // GENERATED_ROOM_AREA)
+    if enemies is None:
+        enemies = area // GENERATED_ENEMY_AREA
+    if keys is None:
+        keys = max(1, area // GENERATED_KEY_AREA)
+    if torches is None:
+        torches = area // GENERATED_TORCH_AREA
+    walls, player = generate_tiles(rng, size, rooms, room_size, corridor_width, wall_density)
+    walls[player] = False
+    occupied = walls.copy()
+    occupied[player] = True
+    key_tiles = pick_tiles(rng, np.argwhere(~occupied), keys)
+    occupied[tuple(key_tiles.T)] = True
+    floor = np.argwhere(~occupied)
+    enemy_tiles = pick_tiles(rng, floor[np.abs(floor - player).max(axis=1) > GENERATED_SAFE_RADIUS], enemies)
+    occupied[tuple(enemy_tiles.T)] = True
+    torch_tiles = pick_tiles(rng, np.argwhere(~occupied), torches)
+
+    pixels = np.empty((*size, 3), dtype=np.uint8)
+    pixels[...] = MAP_COLOR_FLOOR
+    pixels[walls] = MAP_COLOR_WALL
+    pixels[tuple(enemy_tiles.T)] = MAP_COLOR_ENEMY
+    pixels[tuple(key_tiles.T)] = MAP_COLOR_KEY
+    pixels[tuple(torch_tiles.T)] = MAP_COLOR_TORCH
+    pixels[player] = MAP_COLOR_PLAYER
+    return Image.fromarray(pixels.transpose(1, 0, 2))
+
+
+def get_generated_map_name(size, seed=0):
+    return f'generated-{size[0]}x{size[1]}-{seed}.png'
+
+
+def ensure_generated_map(size, seed=0, directory='resources'):
+    map_name = get_generated_map_name(size, seed)
+    map_path = os.path.join(directory, map_name)
+    if not os.path.exists(map_path):
+        generate_map(size, seed=seed).save(map_path)
+    return map_name
+
+
+def parse_size(value):
+    size = tuple(map(int, value.lower().split('x')))
+    return size * 2 if len(size) == 1 else size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate a map image in the resources/map.png color encoding.')
+    parser.add_argument('size', type=parse_size, help='map size in tiles, WIDTHxHEIGHT or SIDE')
+    parser.add_argument('--output', help='image path (default: resources/generated-WxH-SEED.png)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rooms', type=int, help=f'room count (default: one per {GENERATED_ROOM_AREA} tiles)')
+    parser.add_argument('--room-size', type=int, nargs=2, default=GENERATED_ROOM_SIZE, metavar=('MIN', 'MAX'))
+    parser.add_argument('--corridor-width', type=int, default=GENERATED_CORRIDOR_WIDTH)
+    parser.add_argument('--wall-density', type=float, default=GENERATED_WALL_DENSITY)
+    parser.add_argument('--enemies', type=int, help=f'enemy count (default: one per {GENERATED_ENEMY_AREA} tiles)')
+    parser.add_argument('--keys', type=int, help=f'key count (default: one per {GENERATED_KEY_AREA} tiles)')
+    parser.add_argument('--torches', type=int, help=f'torch count (default: one per {GENERATED_TORCH_AREA} tiles)')
+    return parser.parse_args()
+
+
+def run_generator():
+    args = parse_args()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources',
+                                         get_generated_map_name(args.size, args.seed))
+    generate_map(args.size, args.rooms, tuple(args.room_size), args.corridor_width, args.wall_density,
+                 args.enemies, args.keys, args.torches, args.seed).save(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    run_generator()